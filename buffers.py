@@ -0,0 +1,332 @@
+"""
+Device-resident replay storage for the JAX DQN trainer in `main_dqn.py`.
+
+Buffers are immutable pytrees in the style of `flax.training.train_state`:
+`add` and `sample` return new values instead of mutating, so they can be
+called from inside `jax.jit` and `lax.scan`.
+"""
+
+import collections
+import hashlib
+
+import flax
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+
+@flax.struct.dataclass
+class Transition:
+    image: jax.Array
+    arrow: jax.Array
+    action: jax.Array
+    reward: jax.Array
+    done: jax.Array
+    next_image: jax.Array
+    next_arrow: jax.Array
+    discount: jax.Array  # bootstrap factor gamma**k for a k-step transition
+
+
+class ReplayBuffer(flax.struct.PyTreeNode):
+    """
+    Ring buffer of preallocated `jnp` arrays with one row per transition.
+    """
+
+    data: Transition
+    pos: jax.Array
+    size: jax.Array
+    capacity: int = flax.struct.field(pytree_node=False)
+
+    @classmethod
+    def create(cls, capacity: int, example: Transition):
+        """
+        Allocate storage for `capacity` transitions shaped like `example`
+        (a single transition, without a batch dimension)
+        """
+        data = jax.tree.map(
+            lambda x: jnp.zeros((capacity,) + jnp.shape(x), jnp.asarray(x).dtype),
+            example,
+        )
+        return cls(
+            data=data,
+            pos=jnp.zeros((), dtype=jnp.int32),
+            size=jnp.zeros((), dtype=jnp.int32),
+            capacity=capacity,
+        )
+
+    def add(self, transitions: Transition):
+        """
+        Insert a batch of transitions (leading dimension = number of envs)
+        """
+        n = jax.tree.leaves(transitions)[0].shape[0]
+        idx = self._insert_indices(n)
+        data = jax.tree.map(
+            lambda buf, x: buf.at[idx].set(x.astype(buf.dtype)), self.data, transitions
+        )
+        return self.replace(
+            data=data,
+            pos=(self.pos + n) % self.capacity,
+            size=jnp.minimum(self.size + n, self.capacity),
+        )
+
+    def sample(self, key: jax.Array, batch_size: int) -> Transition:
+        """
+        Uniformly sample `batch_size` stored transitions (with replacement)
+        """
+        idx = jax.random.randint(key, (batch_size,), 0, self.size)
+        return jax.tree.map(lambda buf: buf[idx], self.data)
+
+    def _insert_indices(self, n: int) -> jax.Array:
+        return (self.pos + jnp.arange(n)) % self.capacity
+
+
+def sum_tree_update(tree: jax.Array, idx: jax.Array, values: jax.Array):
+    """
+    Set the leaves `idx` of an array-based sum-tree and refresh their
+    ancestors, O(log N) per leaf. Leaf `i` lives at `tree[num_leaves + i]`
+    and node `k` has children `2k` and `2k + 1` (`tree[0]` is unused).
+    """
+    num_leaves = tree.shape[0] // 2
+    pos = idx + num_leaves
+    tree = tree.at[pos].set(values)
+    for _ in range(num_leaves.bit_length() - 1):
+        pos = pos // 2
+        # recomputing the sums (rather than adding deltas) keeps duplicate
+        # indices in the batch consistent
+        tree = tree.at[pos].set(tree[2 * pos] + tree[2 * pos + 1])
+    return tree
+
+
+def sum_tree_sample(tree: jax.Array, key: jax.Array, batch_size: int) -> jax.Array:
+    """
+    Stratified proportional sampling: one leaf per equal slice of the total
+    mass, found by descending the tree for the whole batch at once
+    """
+    num_leaves = tree.shape[0] // 2
+    total = tree[1]
+    mass = (jnp.arange(batch_size) + jax.random.uniform(key, (batch_size,))) * (
+        total / batch_size
+    )
+    pos = jnp.ones(batch_size, dtype=jnp.int32)
+    for _ in range(num_leaves.bit_length() - 1):
+        left = tree[2 * pos]
+        # never walk into an empty subtree because of rounding in `mass`
+        go_right = (mass > left) & (tree[2 * pos + 1] > 0)
+        mass = jnp.where(go_right, mass - left, mass)
+        pos = 2 * pos + go_right
+    return pos - num_leaves
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    Proportional prioritized replay (Schaul et al., 2016) backed by a
+    sum-tree over `priority ** alpha`. New transitions get the largest
+    priority seen so far.
+    """
+
+    tree: jax.Array
+    max_priority: jax.Array
+    alpha: float = flax.struct.field(pytree_node=False)
+    eps: float = flax.struct.field(pytree_node=False)
+
+    @classmethod
+    def create(
+        cls, capacity: int, example: Transition, alpha: float = 0.6, eps: float = 1e-6
+    ):
+        buffer = ReplayBuffer.create(capacity, example)
+        num_leaves = 1 << (capacity - 1).bit_length()
+        return cls(
+            data=buffer.data,
+            pos=buffer.pos,
+            size=buffer.size,
+            capacity=capacity,
+            tree=jnp.zeros(2 * num_leaves, dtype=jnp.float32),
+            max_priority=jnp.ones((), dtype=jnp.float32),
+            alpha=alpha,
+            eps=eps,
+        )
+
+    def add(self, transitions: Transition):
+        n = jax.tree.leaves(transitions)[0].shape[0]
+        tree = sum_tree_update(
+            self.tree, self._insert_indices(n), jnp.full(n, self.max_priority)
+        )
+        return super().add(transitions).replace(tree=tree)
+
+    def sample_prioritized(self, key: jax.Array, batch_size: int, beta):
+        """
+        Returns (transitions, idx, importance-sampling weights normalized by
+        their batch maximum)
+        """
+        idx = sum_tree_sample(self.tree, key, batch_size)
+        idx = jnp.minimum(idx, self.size - 1)
+        num_leaves = self.tree.shape[0] // 2
+        probs = self.tree[num_leaves + idx] / self.tree[1]
+        weights = (self.size * probs) ** -beta
+        weights = weights / weights.max()
+        return jax.tree.map(lambda buf: buf[idx], self.data), idx, weights
+
+    def update_priorities(self, idx: jax.Array, td_errors: jax.Array):
+        priorities = (jnp.abs(td_errors) + self.eps) ** self.alpha
+        return self.replace(
+            tree=sum_tree_update(self.tree, idx, priorities),
+            max_priority=jnp.maximum(self.max_priority, priorities.max()),
+        )
+
+
+class FrameTable:
+    """
+    Content-addressed store of unique observation frames.
+
+    TMaze frames repeat enormously, so instead of keeping full images in every
+    replay row the frames are hashed on the host and interned once into a
+    preallocated device table. Replay rows then hold int32 frame ids, which
+    are turned back into images with `frames[ids]` inside the jitted update.
+
+    The table mirrors the ids written into a replay ring of `replay_capacity`
+    rows (see `store`) and reference-counts them. When it is full, frames that
+    no row references and that `intern` has not returned within the last
+    `hold_steps` steps (ids the caller still holds before storing them) are
+    evicted; if that frees less than a quarter of the table it doubles
+    instead. Every row references at most two frames, so the table never
+    needs more than `2 * replay_capacity` plus the held ids.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        frame_shape: tuple[int, ...],
+        replay_capacity: int,
+        hold_steps: int = 1,
+        dtype=jnp.uint8,
+    ):
+        self.capacity = capacity
+        self.hold_steps = hold_steps
+        self.frames = jnp.zeros((capacity,) + tuple(frame_shape), dtype=dtype)
+        self.ids: dict[bytes, int] = {}
+        self.digests: list[bytes | None] = []
+        self.free: list[int] = []
+        self.refs = np.zeros(capacity, dtype=np.int64)
+        self.last_seen = np.zeros(capacity, dtype=np.int64)
+        self.rows = np.full((replay_capacity, 2), -1, dtype=np.int64)
+        self.pos = 0
+        self._set = jax.jit(
+            lambda table, idx, frames: table.at[idx].set(frames), donate_argnums=0
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, frames: np.ndarray, step: int) -> np.ndarray:
+        """
+        Return the id of every frame in the batch, storing unseen ones. The
+        ids are kept alive until `step + hold_steps` even if no row uses them
+        """
+        ids = np.empty(len(frames), dtype=np.int32)
+        new_ids, new_frames = [], []
+        for i, frame in enumerate(frames):
+            digest = hashlib.blake2b(
+                np.ascontiguousarray(frame).data, digest_size=16
+            ).digest()
+            frame_id = self.ids.get(digest)
+            if frame_id is None:
+                frame_id = self._allocate(step)
+                self.ids[digest] = frame_id
+                self.digests[frame_id] = digest
+                new_ids.append(frame_id)
+                new_frames.append(frame)
+            self.last_seen[frame_id] = step
+            ids[i] = frame_id
+
+        if new_ids:
+            self.frames = self._set(
+                self.frames, np.array(new_ids), np.stack(new_frames)
+            )
+        return ids
+
+    def store(self, image_ids: np.ndarray, next_image_ids: np.ndarray):
+        """
+        Record the ids of a batch of transitions just added to the replay
+        buffer, releasing the frames of the rows they overwrite
+        """
+        idx = (self.pos + np.arange(len(image_ids))) % len(self.rows)
+        old = self.rows[idx]
+        self.rows[idx, 0] = image_ids
+        self.rows[idx, 1] = next_image_ids
+        np.add.at(self.refs, self.rows[idx].ravel(), 1)
+        np.subtract.at(self.refs, old[old >= 0], 1)
+        self.pos = (self.pos + len(image_ids)) % len(self.rows)
+
+    def _allocate(self, step: int) -> int:
+        if len(self.digests) < self.capacity:
+            self.digests.append(None)
+            return len(self.digests) - 1
+        if not self.free:
+            unused = (self.refs == 0) & (self.last_seen < step - self.hold_steps)
+            self.free = np.flatnonzero(unused).tolist()
+            for frame_id in self.free:
+                del self.ids[self.digests[frame_id]]
+                self.digests[frame_id] = None
+            if len(self.free) < self.capacity // 4:
+                self._grow()
+        return self.free.pop()
+
+    def _grow(self):
+        old_capacity = self.capacity
+        self.capacity *= 2
+        self.frames = jnp.concatenate([self.frames, jnp.zeros_like(self.frames)])
+        self.refs = np.concatenate([self.refs, np.zeros(old_capacity, np.int64)])
+        self.last_seen = np.concatenate(
+            [self.last_seen, np.zeros(old_capacity, np.int64)]
+        )
+        self.free.extend(range(self.capacity - 1, old_capacity - 1, -1))
+        self.digests.extend([None] * old_capacity)
+
+
+class NStepBuffer:
+    """
+    Host-side stage between `envs.step` and replay insertion that turns
+    1-step transitions into n-step ones.
+
+    Each env keeps a deque of its latest transitions. A full window of
+    `n_step` transitions is folded into one, and when an episode terminates
+    or is truncated every pending window is flushed with a shorter horizon.
+    `discount` holds `gamma ** k` for the `k` steps actually folded, so
+    truncated episodes still bootstrap from their final observation.
+    """
+
+    def __init__(self, n_step: int, gamma: float, num_envs: int):
+        self.n_step = n_step
+        self.gamma = gamma
+        self.windows = [collections.deque() for _ in range(num_envs)]
+
+    def push(self, transitions: Transition, episode_ends: np.ndarray):
+        """
+        Add one vector step of 1-step transitions and return the n-step
+        transitions that became ready, or None
+        """
+        transitions = jax.tree.map(np.asarray, transitions)
+        ready = []
+        for env_idx, window in enumerate(self.windows):
+            window.append(jax.tree.map(lambda x: x[env_idx], transitions))
+            if episode_ends[env_idx]:
+                while window:
+                    ready.append(self._fold(window))
+                    window.popleft()
+            elif len(window) == self.n_step:
+                ready.append(self._fold(window))
+                window.popleft()
+
+        if not ready:
+            return None
+        return jax.tree.map(lambda *xs: np.stack(xs), *ready)
+
+    def _fold(self, window) -> Transition:
+        first, last = window[0], window[-1]
+        return first.replace(
+            reward=sum(self.gamma**i * t.reward for i, t in enumerate(window)),
+            done=last.done,
+            next_image=last.next_image,
+            next_arrow=last.next_arrow,
+            discount=np.float32(self.gamma ** len(window)),
+        )
@@ -0,0 +1,355 @@
+"""
+Local batched inference for trained TMaze policies.
+
+Callers `submit(image, arrow)` from any thread and get a
+`concurrent.futures.Future` resolving to a `Decision`. Requests are grouped
+by a `DynamicBatcher`, which runs a batch as soon as it is full or the oldest
+request has waited `max_latency` seconds.
+
+`GatedPolicyServer` serves the torch `GatedAgent` from `networks.py` in two
+stages: a router batch runs the gate and answers cheap-routed requests with
+`CheapNet` straight away, and only heavy-routed requests are forwarded to a
+separate HeavyNet batcher, so cheap requests never wait on a heavy batch.
+`QNetworkServer` serves the JAX Q-network from `main_dqn.py` greedily.
+
+Running this file starts a server and a closed-loop load generator and prints
+p50/p99 latency and throughput.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Callable, NamedTuple
+
+import numpy as np
+import torch
+
+
+class Decision(NamedTuple):
+    action: int
+    branch: str  # "cheap", "heavy" or "q"
+
+
+@dataclass
+class Request:
+    image: np.ndarray
+    arrow: np.ndarray
+    future: Future
+    arrival: float
+
+
+class DynamicBatcher:
+    """
+    Worker thread that hands queued requests to `handler` in batches of at
+    most `max_batch_size`, waiting at most `max_latency` seconds after the
+    oldest request of a batch arrived
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list[Request]], None],
+        max_batch_size: int = 256,
+        max_latency: float = 0.002,
+        name: str = "batcher",
+    ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue: queue.Queue[Request | None] = queue.Queue()
+        self.batch_sizes: list[int] = []
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, request: Request):
+        self.queue.put(request)
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = first.arrival + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = (
+                        self.queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self.queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+
+            self.batch_sizes.append(len(batch))
+            try:
+                self.handler(batch)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+
+class GatedPolicyServer:
+    """
+    Serve a `networks.GatedAgent`. `greedy` picks the arg-max action instead
+    of sampling from the policy.
+    """
+
+    def __init__(
+        self,
+        agent,
+        device: str | torch.device = "cpu",
+        max_batch_size: int = 256,
+        max_latency: float = 0.002,
+        heavy_max_latency: float | None = None,
+        greedy: bool = True,
+    ):
+        self.agent = agent.to(device).eval()
+        self.device = torch.device(device)
+        self.greedy = greedy
+        self.heavy = DynamicBatcher(
+            self._run_heavy,
+            max_batch_size,
+            max_latency if heavy_max_latency is None else heavy_max_latency,
+            name="heavy",
+        )
+        self.router = DynamicBatcher(
+            self._route, max_batch_size, max_latency, name="router"
+        )
+
+    def submit(self, image: np.ndarray, arrow: np.ndarray) -> Future:
+        future = Future()
+        self.router.submit(Request(image, arrow, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self.router.close()
+        self.heavy.close()
+
+    def _stack(self, requests: list[Request]):
+        image = torch.as_tensor(np.stack([r.image for r in requests]))
+        arrow = torch.as_tensor(np.stack([r.arrow for r in requests]))
+        return image.to(self.device), arrow.to(self.device, torch.float32)
+
+    def _act(self, logits: torch.Tensor) -> np.ndarray:
+        if self.greedy:
+            return logits.argmax(-1).cpu().numpy()
+        return torch.distributions.Categorical(logits=logits).sample().cpu().numpy()
+
+    def _route(self, requests: list[Request]):
+        image, arrow = self._stack(requests)
+        with torch.no_grad():
+            cheap_mask = (self.agent.gate(image, arrow) > 0.5).cpu().numpy()
+            idx_c = np.flatnonzero(cheap_mask)
+            if len(idx_c):
+                logits, _ = self.agent.cheap(image[idx_c], arrow[idx_c])
+                for i, action in zip(idx_c, self._act(logits)):
+                    requests[i].future.set_result(Decision(int(action), "cheap"))
+        for i in np.flatnonzero(~cheap_mask):
+            self.heavy.submit(requests[i])
+
+    def _run_heavy(self, requests: list[Request]):
+        image, _ = self._stack(requests)
+        with torch.no_grad():
+            logits, _ = self.agent.heavy(image)
+        for request, action in zip(requests, self._act(logits)):
+            request.future.set_result(Decision(int(action), "heavy"))
+
+
+class QNetworkServer:
+    """
+    Serve a Flax Q-network `apply_fn(params, image, arrow)` (e.g.
+    `networks_jax.HeavyNet` as trained by `main_dqn.py`) greedily. Batches
+    are padded to powers of two so only `log2(max_batch_size)` shapes are
+    ever compiled.
+    """
+
+    def __init__(
+        self,
+        apply_fn,
+        params,
+        max_batch_size: int = 256,
+        max_latency: float = 0.002,
+    ):
+        import jax
+        import jax.numpy as jnp
+
+        self.params = params
+        self._act = jax.jit(
+            lambda params, image, arrow: jnp.argmax(apply_fn(params, image, arrow), -1)
+        )
+        self.batcher = DynamicBatcher(self._run, max_batch_size, max_latency, "q")
+
+    def submit(self, image: np.ndarray, arrow: np.ndarray) -> Future:
+        future = Future()
+        self.batcher.submit(Request(image, arrow, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self.batcher.close()
+
+    def _run(self, requests: list[Request]):
+        size = len(requests)
+        padded = 1 << (size - 1).bit_length()
+        image = np.stack([r.image for r in requests])
+        arrow = np.stack([r.arrow for r in requests]).astype(np.float32)
+        if padded > size:
+            image = np.concatenate([image, np.repeat(image[-1:], padded - size, 0)])
+            arrow = np.concatenate([arrow, np.repeat(arrow[-1:], padded - size, 0)])
+        actions = np.asarray(self._act(self.params, image, arrow))
+        for request, action in zip(requests, actions[:size]):
+            request.future.set_result(Decision(int(action), "q"))
+
+
+@dataclass
+class Args:
+    backend: str = "gated"
+    """the policy to serve: `gated` (torch GatedAgent) or `q` (JAX HeavyNet Q-network)"""
+    model_path: str = ""
+    """a saved `GatedAgent.state_dict()` or `main_dqn.py` `.cleanrl_model`; random weights if empty"""
+    clients: int = 64
+    """the number of concurrent closed-loop clients"""
+    duration: float = 5.0
+    """seconds to generate load for"""
+    max_batch_size: int = 256
+    """the largest batch handed to a network"""
+    max_latency_ms: float = 2.0
+    """how long the oldest request of a batch may wait for more requests"""
+    cheap_fraction: float = 0.5
+    """without `model-path`, the gate is set to route this fraction of `gated` requests cheap"""
+
+
+def run_load(server, sample_request, clients: int, duration: float):
+    """
+    `clients` threads each submit a request, wait for it and repeat until
+    `duration` seconds have passed; returns (latencies by branch, elapsed)
+    """
+    latencies: dict[str, list[float]] = {}
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def client(seed):
+        rng = np.random.default_rng(seed)
+        local: dict[str, list[float]] = {}
+        while time.perf_counter() < stop:
+            image, arrow = sample_request(rng)
+            start = time.perf_counter()
+            decision = server.submit(image, arrow).result()
+            local.setdefault(decision.branch, []).append(time.perf_counter() - start)
+        with lock:
+            for branch, values in local.items():
+                latencies.setdefault(branch, []).extend(values)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    from types import SimpleNamespace
+
+    import gymnasium as gym
+    import tyro
+
+    args = tyro.cli(Args)
+    max_latency = args.max_latency_ms / 1e3
+
+    if args.backend == "gated":
+        from networks import GatedAgent
+
+        image_shape = (7, 7, 3)
+        envs = SimpleNamespace(
+            single_observation_space=gym.spaces.Dict(
+                {
+                    "image": gym.spaces.Box(0, 255, image_shape, np.uint8),
+                    "arrow": gym.spaces.Box(0, 1, (1,), np.float32),
+                }
+            ),
+            single_action_space=gym.spaces.Discrete(7),
+        )
+        agent = GatedAgent(envs)
+        if args.model_path:
+            agent.load_state_dict(torch.load(args.model_path, map_location="cpu"))
+        else:
+            # constant gate logits: the Gumbel noise then picks the cheap
+            # branch with probability `cheap_fraction`
+            gate_out = agent.gate.net[-1]
+            with torch.no_grad():
+                gate_out.weight.zero_()
+                gate_out.bias.copy_(
+                    torch.tensor(
+                        [0.0, np.log(args.cheap_fraction / (1 - args.cheap_fraction))]
+                    )
+                )
+        server = GatedPolicyServer(
+            agent, max_batch_size=args.max_batch_size, max_latency=max_latency
+        )
+
+        def sample_request(rng):
+            image = rng.integers(0, 11, image_shape, dtype=np.uint8)
+            return image, rng.random(1, dtype=np.float32)
+
+    elif args.backend == "q":
+        import flax
+        import jax
+
+        from networks_jax import HeavyNet
+
+        image_shape = (88, 88)
+        q_network = HeavyNet(action_dim=4)
+        params = q_network.init(
+            jax.random.PRNGKey(0),
+            np.zeros((1,) + image_shape, np.uint8),
+            np.zeros((1, 4), np.float32),
+        )
+        if args.model_path:
+            with open(args.model_path, "rb") as f:
+                params = flax.serialization.from_bytes(params, f.read())
+        server = QNetworkServer(
+            q_network.apply, params, args.max_batch_size, max_latency
+        )
+        # compile every padded batch shape before timing
+        for size in (1 << i for i in range(args.max_batch_size.bit_length())):
+            server._act(
+                params,
+                np.zeros((size,) + image_shape, np.uint8),
+                np.zeros((size, 4), np.float32),
+            ).block_until_ready()
+
+        def sample_request(rng):
+            image = rng.integers(0, 256, image_shape, dtype=np.uint8)
+            return image, rng.uniform(-1, 1, 4).astype(np.float32)
+
+    else:
+        raise ValueError(f"unknown backend {args.backend}")
+
+    run_load(server, sample_request, args.clients, 0.5)  # warm-up
+    latencies, elapsed = run_load(server, sample_request, args.clients, args.duration)
+    server.close()
+
+    total = sum(len(values) for values in latencies.values())
+    print(
+        f"{args.backend}: {total / elapsed:.0f} requests/s with {args.clients} clients"
+    )
+    for branch, values in sorted(latencies.items()):
+        values = np.array(values) * 1e3
+        print(
+            f"  {branch:5s} {len(values) / total:5.1%} of requests  "
+            f"p50 {np.percentile(values, 50):6.2f} ms  p99 {np.percentile(values, 99):6.2f} ms"
+        )
@@ -3,7 +3,8 @@ from __future__ import annotations
 import os
 import random
 import time
-from dataclasses import dataclass
+import warnings
+from dataclasses import dataclass, fields
 
 import gymnasium as gym
 import numpy as np
@@ -27,7 +28,8 @@ from minigrid.core.world_object import Goal, Lava, Box
 from minigrid.minigrid_env import MiniGridEnv
 from gymnasium.envs.registration import register
 
-from networks import GatedAgent
+from networks import ComputeMeter, GatedAgent
+from shm_vector_env import SharedMemoryVectorEnv
 
 
 class ImgObsPositionWrapper(gym.ObservationWrapper):
@@ -176,7 +178,7 @@ class TMaze(MiniGridEnv):
                     low=0,
                     high=1,
                     shape=(1,),
-                    dtype="int64",
+                    dtype="float32",
                 ),
             }
         )
@@ -206,7 +208,7 @@ class TMaze(MiniGridEnv):
         # Either place a goal square in the top-left or top-right corner
         goal_positions = [(1, 1), (width - 2, 1)]
         self.goal_position = self.np_random.choice(goal_positions)
-        self.arrow_position = self.goal_position == (width - 2, 1)
+        self.arrow_position = np.array_equal(self.goal_position, (width - 2, 1))
         self.put_obj(Goal(), *self.goal_position)
 
         # Place a green box in a random valid position
@@ -284,7 +286,6 @@ class TMaze(MiniGridEnv):
         # - the agent's direction/orientation (acting as a compass)
         # - a textual mission string (instructions for the agent)
 
-        print(self.agent_pos)
         maybe_random_arrow = np.random.randint(0, 1)
         if self.agent_pos[0] == (self.height - 1) // 2 and self.agent_pos[1] == 1:
             maybe_random_arrow = self.arrow_position
@@ -294,7 +295,7 @@ class TMaze(MiniGridEnv):
             "direction": self.agent_dir,
             "mission": self.mission,
             "position": self.agent_pos,
-            "arrow": float(maybe_random_arrow),
+            "arrow": np.array([maybe_random_arrow], dtype=np.float32),
         }
         return obs
 
@@ -334,6 +335,10 @@ class Args:
     """the learning rate of the optimizer"""
     num_envs: int = 1
     """the number of parallel game environments"""
+    async_envs: bool = False
+    """if toggled, the environments are stepped in subprocesses with `gym.vector.AsyncVectorEnv`"""
+    shared_memory_envs: bool = False
+    """if toggled, the environments are stepped in subprocesses that write observations into shared memory (`shm_vector_env`)"""
     num_steps: int = 128
     """the number of steps to run in each environment per policy rollout"""
     anneal_lr: bool = True
@@ -362,6 +367,12 @@ class Args:
     """the target KL divergence threshold"""
     compute_penalty: float = 0.003
     """negative reward whenever the heavy branch is executed"""
+    time_branches: bool = False
+    """if toggled, each expert call is synchronized and timed for the `compute/` latency charts (not with `compile-agent`, whose fused forward runs both experts in one graph)"""
+    compile_agent: bool = False
+    """if toggled, `GatedAgent` runs a fused gate + experts + sampling forward compiled with `torch.compile` (eager if compilation fails)"""
+    bf16: bool = False
+    """if toggled, the experts' conv and linear layers run under bfloat16 autocast (weights, losses and optimizer state stay float32)"""
 
     # to be filled in runtime
     batch_size: int = 0
@@ -372,9 +383,99 @@ class Args:
     """the number of iterations (computed in runtime)"""
 
 
-def make_env(env_id, capture_video, run_name):
+def compute_gae(
+    rewards: torch.Tensor,
+    values: torch.Tensor,
+    dones: torch.Tensor,
+    next_value: torch.Tensor,
+    next_done: torch.Tensor,
+    gamma: float,
+    gae_lambda: float,
+    block_size: int = 16,
+) -> torch.Tensor:
+    """
+    Generalized advantage estimates for a (num_steps, num_envs) rollout, where
+    `dones[t]` flags that step `t` starts a new episode (as stored by the
+    rollout loop) and `next_value` / `next_done` describe the step after it.
+
+    The recursion `A[t] = delta[t] + gamma * lambda * nonterminal[t+1] * A[t+1]`
+    is unrolled within blocks of `block_size` steps as a batched matrix product
+    with `W[t, k] = (gamma * lambda) ** (k - t)` when no episode ends in
+    between, leaving only `num_steps / block_size` sequential steps to carry
+    advantages from one block into the previous one.
+    """
+    num_steps, num_envs = rewards.shape
+    next_nonterminal = 1.0 - torch.cat([dones[1:], next_done.reshape(1, -1)])
+    next_values = torch.cat([values[1:], next_value.reshape(1, -1)])
+    deltas = rewards + gamma * next_values * next_nonterminal - values
+
+    # Pad to whole blocks; padded steps have no advantage and cut the chain
+    num_blocks = -(-num_steps // block_size)
+    pad = num_blocks * block_size - num_steps
+    deltas = nn.functional.pad(deltas, (0, 0, 0, pad))
+    next_nonterminal = nn.functional.pad(next_nonterminal, (0, 0, 0, pad))
+    deltas = deltas.reshape(num_blocks, block_size, num_envs)
+    next_nonterminal = next_nonterminal.reshape(num_blocks, block_size, num_envs)
+
+    # Number of episode ends among the links before step k of each block;
+    # steps t <= k are in the same episode when the counts agree
+    ends = torch.cumsum(1.0 - next_nonterminal, dim=1)
+    ends = nn.functional.pad(ends, (0, 0, 1, 0))  # (blocks, block_size + 1, envs)
+    same_episode = ends[:, None, :, :] == ends[:, :, None, :]
+    idx = torch.arange(block_size + 1, device=rewards.device)
+    offsets = idx[None, :] - idx[:, None]  # k - t
+    powers = (gamma * gae_lambda) ** offsets.clamp(min=0).to(rewards.dtype)
+    weights = torch.where(
+        (offsets >= 0)[None, :, :, None] & same_episode,
+        powers[None, :, :, None],
+        0.0,
+    )
+
+    local = torch.einsum("btkn,bkn->btn", weights[:, :block_size, :block_size], deltas)
+    # weight of the advantage right after the block, for every step in it
+    tail = weights[:, :block_size, block_size]
+
+    advantages = torch.empty_like(local)
+    carry = torch.zeros_like(local[0, 0])
+    for block in reversed(range(num_blocks)):
+        advantages[block] = local[block] + tail[block] * carry
+        carry = advantages[block, 0]
+    return advantages.reshape(-1, num_envs)[:num_steps]
+
+
+@dataclass
+class RolloutBatch:
+    """
+    A flattened rollout, one row per sample. `permute` gathers every field
+    into contiguous storage once per epoch, after which `minibatches` yields
+    zero-copy slices of it.
+    """
+
+    obs: torch.Tensor
+    arrows: torch.Tensor
+    actions: torch.Tensor  # long, as `get_action_and_value` indexes with them
+    logprobs: torch.Tensor
+    advantages: torch.Tensor
+    returns: torch.Tensor
+    values: torch.Tensor
+
+    def __len__(self):
+        return self.obs.size(0)
+
+    def _map(self, fn):
+        return RolloutBatch(*(fn(getattr(self, f.name)) for f in fields(self)))
+
+    def permute(self, perm: torch.Tensor) -> RolloutBatch:
+        return self._map(lambda x: x.index_select(0, perm))
+
+    def minibatches(self, minibatch_size: int):
+        for start in range(0, len(self), minibatch_size):
+            yield self._map(lambda x: x[start : start + minibatch_size])
+
+
+def make_env(env_id, idx, capture_video, run_name):
     def thunk():
-        if capture_video:
+        if capture_video and idx == 0:
             env = gym.make(env_id, render_mode="rgb_array")
             env = gym.wrappers.RecordVideo(
                 env,
@@ -384,11 +485,11 @@ def make_env(env_id, capture_video, run_name):
             )
         else:
             env = gym.make(env_id)
+        env = gym.wrappers.FilterObservation(env, ["image", "arrow"])
         env = gym.wrappers.RecordEpisodeStatistics(env)
-        env = ImgObsPositionWrapper(env)
         return env
 
-    return thunk()
+    return thunk
 
 
 def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
@@ -413,12 +514,12 @@ class Agent(nn.Module):
         self.critic = layer_init(nn.Linear(64, 1), std=1)
 
     def get_value(self, x):
-        reshaped = x.permute(0, 3, 1, 2)
+        reshaped = x.permute(0, 3, 1, 2).float()
         hidden = self.network(reshaped)
         return self.critic(hidden)
 
     def get_action_and_value(self, x, action=None):
-        reshaped = x.permute(0, 3, 1, 2)
+        reshaped = x.permute(0, 3, 1, 2).float()
         hidden = self.network(reshaped)
         logits = self.actor(hidden)
         probs = Categorical(logits=logits)
@@ -461,22 +562,53 @@ if __name__ == "__main__":
     device = torch.device("cuda" if torch.cuda.is_available() and args.cuda else "cpu")
 
     # env setup
-    envs = make_env(args.env_id, args.capture_video, run_name)
+    assert not (
+        args.async_envs and args.shared_memory_envs
+    ), "choose one of async_envs and shared_memory_envs"
+    env_fns = [
+        make_env(args.env_id, i, args.capture_video, run_name)
+        for i in range(args.num_envs)
+    ]
+    if args.shared_memory_envs:
+        # read observations in place: each step's `next_obs` is copied into
+        # the rollout storage before the next `envs.step` overwrites it
+        envs = SharedMemoryVectorEnv(env_fns, copy=False)
+    else:
+        vector_env_cls = (
+            gym.vector.AsyncVectorEnv if args.async_envs else gym.vector.SyncVectorEnv
+        )
+        envs = vector_env_cls(
+            env_fns, autoreset_mode=gym.vector.AutoresetMode.SAME_STEP
+        )
     assert isinstance(
-        envs.action_space, gym.spaces.Discrete
+        envs.single_action_space, gym.spaces.Discrete
     ), "only discrete action space is supported"
 
     agent = GatedAgent(envs).to(device)
     optimizer = optim.Adam(agent.parameters(), lr=args.learning_rate, eps=1e-5)
+    agent.time_branches = args.time_branches
+    agent.autocast_dtype = torch.bfloat16 if args.bf16 else None
+    if args.compile_agent:
+        agent.use_fused_forward()
+        if args.time_branches:
+            warnings.warn(
+                "--time-branches has no effect with --compile-agent: the fused "
+                "forward cannot be split into per-expert timings"
+            )
+    compute_meter = ComputeMeter(agent)
 
     # ALGO Logic: Storage setup
+    # observations stay uint8 MiniGrid encodings; the networks cast them
     obs = torch.zeros(
-        (args.num_steps, args.num_envs) + envs.observation_space.shape
+        (args.num_steps, args.num_envs) + envs.single_observation_space["image"].shape,
+        dtype=torch.uint8,
+    ).to(device)
+    actions = torch.zeros(
+        (args.num_steps, args.num_envs) + envs.single_action_space.shape
+    ).to(device)
+    arrows = torch.zeros(
+        (args.num_steps, args.num_envs) + envs.single_observation_space["arrow"].shape
     ).to(device)
-    actions = torch.zeros((args.num_steps, args.num_envs) + envs.action_space.shape).to(
-        device
-    )
-    arrows = torch.zeros((args.num_steps, args.num_envs)).to(device)
     logprobs = torch.zeros((args.num_steps, args.num_envs)).to(device)
     rewards = torch.zeros((args.num_steps, args.num_envs)).to(device)
     dones = torch.zeros((args.num_steps, args.num_envs)).to(device)
@@ -485,10 +617,9 @@ if __name__ == "__main__":
     # TRY NOT TO MODIFY: start the game
     global_step = 0
     start_time = time.time()
-    (next_obs, full_obs), _ = envs.reset(seed=args.seed)
-    next_obs = torch.Tensor(next_obs).to(device)
-    next_obs = next_obs.unsqueeze(0)
-
+    next_obs, _ = envs.reset(seed=args.seed)
+    next_arrow = torch.Tensor(next_obs["arrow"]).to(device)
+    next_obs = torch.as_tensor(next_obs["image"]).to(device)
     next_done = torch.zeros(args.num_envs).to(device)
 
     for iteration in range(1, args.num_iterations + 1):
@@ -501,90 +632,77 @@ if __name__ == "__main__":
         for step in range(0, args.num_steps):
             global_step += args.num_envs
             obs[step] = next_obs
-            arrows[step] = full_obs["arrow"]
+            arrows[step] = next_arrow
             dones[step] = next_done
 
             # ALGO LOGIC: action logic
             with torch.no_grad():
                 action, logprob, _, value = agent.get_action_and_value(
-                    next_obs, arrow=torch.tensor(full_obs["arrow"]).unsqueeze(0)
+                    next_obs, arrow=next_arrow
                 )
                 values[step] = value.flatten()
+            compute_meter.record()
             actions[step] = action
             logprobs[step] = logprob
 
             # TRY NOT TO MODIFY: execute the game and log data.
-            (next_obs, full_obs), reward, terminations, truncations, infos = envs.step(
+            next_obs, reward, terminations, truncations, infos = envs.step(
                 action.cpu().numpy()
             )
-            next_obs = np.expand_dims(next_obs, axis=0)
-            terminations = np.expand_dims(terminations, axis=0)
-            truncations = np.expand_dims(truncations, axis=0)
 
             # If the heavy branch was used add the compute penalty
             penalty = (1 - agent._last_gate.float()) * args.compute_penalty
-            reward -= penalty.cpu().numpy()  # broadcast over envs
+            reward = reward - penalty.cpu().numpy()  # one penalty per env
             next_done = np.logical_or(terminations, truncations)
             rewards[step] = torch.tensor(reward).to(device).view(-1)
-            next_obs, next_done = torch.Tensor(next_obs).to(device), torch.Tensor(
-                next_done
-            ).to(device)
-
-            if any(terminations) or any(truncations):
-                writer.add_scalar(
-                    "charts/episodic_return",
-                    infos["episode"]["r"],
-                    global_step,
-                )
-                writer.add_scalar(
-                    "charts/episodic_length",
-                    infos["episode"]["l"],
-                    global_step,
-                )
+            next_arrow = torch.Tensor(next_obs["arrow"]).to(device)
+            next_obs = torch.as_tensor(next_obs["image"]).to(device)
+            next_done = torch.Tensor(next_done).to(device)
+
+            if "final_info" in infos and "episode" in infos["final_info"]:
+                episode = infos["final_info"]["episode"]
+                for idx in np.flatnonzero(infos["final_info"]["_episode"]):
+                    writer.add_scalar(
+                        "charts/episodic_return", episode["r"][idx], global_step
+                    )
+                    writer.add_scalar(
+                        "charts/episodic_length", episode["l"][idx], global_step
+                    )
 
         # bootstrap value if not done
         with torch.no_grad():
-            next_value = agent.get_value(next_obs).reshape(1, -1)
-            advantages = torch.zeros_like(rewards).to(device)
-            lastgaelam = 0
-            for t in reversed(range(args.num_steps)):
-                if t == args.num_steps - 1:
-                    nextnonterminal = 1.0 - next_done
-                    nextvalues = next_value
-                else:
-                    nextnonterminal = 1.0 - dones[t + 1]
-                    nextvalues = values[t + 1]
-                delta = (
-                    rewards[t] + args.gamma * nextvalues * nextnonterminal - values[t]
-                )
-                advantages[t] = lastgaelam = (
-                    delta + args.gamma * args.gae_lambda * nextnonterminal * lastgaelam
-                )
+            next_value = agent.get_value(next_obs, next_arrow).reshape(1, -1)
+            advantages = compute_gae(
+                rewards,
+                values,
+                dones,
+                next_value,
+                next_done,
+                args.gamma,
+                args.gae_lambda,
+            )
             returns = advantages + values
 
         # flatten the batch
-        b_obs = obs.reshape((-1,) + envs.observation_space.shape)
-        b_logprobs = logprobs.reshape(-1)
-        b_actions = actions.reshape((-1,) + envs.action_space.shape)
-        b_advantages = advantages.reshape(-1)
-        b_returns = returns.reshape(-1)
-        b_values = values.reshape(-1)
+        b = RolloutBatch(
+            obs=obs.reshape((-1,) + envs.single_observation_space["image"].shape),
+            arrows=arrows.reshape((-1,) + envs.single_observation_space["arrow"].shape),
+            actions=actions.reshape((-1,) + envs.single_action_space.shape).long(),
+            logprobs=logprobs.reshape(-1),
+            advantages=advantages.reshape(-1),
+            returns=returns.reshape(-1),
+            values=values.reshape(-1),
+        )
 
         # Optimizing the policy and value network
-        b_inds = np.arange(args.batch_size)
         clipfracs = []
         for epoch in range(args.update_epochs):
-            np.random.shuffle(b_inds)
-            for start in range(0, args.batch_size, args.minibatch_size):
-                end = start + args.minibatch_size
-                mb_inds = b_inds[start:end]
-
+            perm = torch.randperm(args.batch_size, device=device)
+            for mb in b.permute(perm).minibatches(args.minibatch_size):
                 _, newlogprob, entropy, newvalue = agent.get_action_and_value(
-                    b_obs[mb_inds],
-                    b_actions.long()[mb_inds],
-                    arrow=torch.tensor(full_obs["arrow"]).unsqueeze(0),
+                    mb.obs, arrow=mb.arrows, action=mb.actions
                 )
-                logratio = newlogprob - b_logprobs[mb_inds]
+                logratio = newlogprob - mb.logprobs
                 ratio = logratio.exp()
 
                 with torch.no_grad():
@@ -595,7 +713,7 @@ if __name__ == "__main__":
                         ((ratio - 1.0).abs() > args.clip_coef).float().mean().item()
                     ]
 
-                mb_advantages = b_advantages[mb_inds]
+                mb_advantages = mb.advantages
                 if args.norm_adv:
                     mb_advantages = (mb_advantages - mb_advantages.mean()) / (
                         mb_advantages.std() + 1e-8
@@ -611,17 +729,17 @@ if __name__ == "__main__":
                 # Value loss
                 newvalue = newvalue.view(-1)
                 if args.clip_vloss:
-                    v_loss_unclipped = (newvalue - b_returns[mb_inds]) ** 2
-                    v_clipped = b_values[mb_inds] + torch.clamp(
-                        newvalue - b_values[mb_inds],
+                    v_loss_unclipped = (newvalue - mb.returns) ** 2
+                    v_clipped = mb.values + torch.clamp(
+                        newvalue - mb.values,
                         -args.clip_coef,
                         args.clip_coef,
                     )
-                    v_loss_clipped = (v_clipped - b_returns[mb_inds]) ** 2
+                    v_loss_clipped = (v_clipped - mb.returns) ** 2
                     v_loss_max = torch.max(v_loss_unclipped, v_loss_clipped)
                     v_loss = 0.5 * v_loss_max.mean()
                 else:
-                    v_loss = 0.5 * ((newvalue - b_returns[mb_inds]) ** 2).mean()
+                    v_loss = 0.5 * ((newvalue - mb.returns) ** 2).mean()
 
                 entropy_loss = entropy.mean()
                 loss = pg_loss - args.ent_coef * entropy_loss + v_loss * args.vf_coef
@@ -634,7 +752,7 @@ if __name__ == "__main__":
             if args.target_kl is not None and approx_kl > args.target_kl:
                 break
 
-        y_pred, y_true = b_values.cpu().numpy(), b_returns.cpu().numpy()
+        y_pred, y_true = b.values.cpu().numpy(), b.returns.cpu().numpy()
         var_y = np.var(y_true)
         explained_var = np.nan if var_y == 0 else 1 - np.var(y_true - y_pred) / var_y
 
@@ -649,6 +767,7 @@ if __name__ == "__main__":
         writer.add_scalar("losses/approx_kl", approx_kl.item(), global_step)
         writer.add_scalar("losses/clipfrac", np.mean(clipfracs), global_step)
         writer.add_scalar("losses/explained_variance", explained_var, global_step)
+        compute_meter.write(writer, global_step)
         # print("SPS:", int(global_step / (time.time() - start_time)))
         writer.add_scalar(
             "charts/SPS", int(global_step / (time.time() - start_time)), global_step
@@ -1,8 +1,11 @@
 # docs and experiment results can be found at https://docs.cleanrl.dev/rl-algorithms/dqn/#dqn_jaxpy
+import collections
 import os
 import random
 import time
+import warnings
 from dataclasses import dataclass
+from functools import partial
 from enum import IntEnum
 
 import flax
@@ -10,7 +13,6 @@ import flax.linen as nn
 import gymnasium as gym
 import jax
 import jax.numpy as jnp
-import minigrid
 import numpy as np
 import optax
 import tyro
@@ -35,10 +37,24 @@ from minigrid.utils.rendering import (
 )
 from tqdm import tqdm
 from minigrid.wrappers import ImgObsWrapper
-from stable_baselines3.common.buffers import DictReplayBuffer
 from torch.utils.tensorboard import SummaryWriter
 
+from buffers import (
+    FrameTable,
+    NStepBuffer,
+    PrioritizedReplayBuffer,
+    ReplayBuffer,
+    Transition,
+)
 from networks_jax import CheapNet, GatedDQN, HeavyNet
+from shm_vector_env import SharedMemoryVectorEnv
+from tmaze_jax import (
+    EMPTY,
+    NUM_TILE_KINDS,
+    OBJECT_KINDS,
+    TMazeJax,
+    to_grayscale,
+)
 
 from typing import Any, Iterable, SupportsFloat, TypeVar
 
@@ -154,18 +170,31 @@ class DirectionlessGrid(Grid):
         highlight: bool = False,
         tile_size: int = TILE_PIXELS,
         subdivs: int = 3,
+        grayscale: bool = False,
     ) -> np.ndarray:
         """
         Render a tile and cache the result
+
+        With `grayscale` the tile is converted like `GrayscaleObservation`
+        once and cached as a single-channel uint8 tile.
         """
 
         # Hash map lookup key for the cache
         key: tuple[Any, ...] = (agent_dir, highlight, tile_size)
         key = obj.encode() + key if obj else key
+        if grayscale:
+            key = key + ("grayscale",)
 
         if key in cls.tile_cache:
             return cls.tile_cache[key]
 
+        if grayscale:
+            rgb = cls.render_tile(obj, agent_dir, highlight, tile_size, subdivs)
+            # the RGB frame holds the truncated uint8 tile before conversion
+            img = to_grayscale(rgb.astype(np.uint8))
+            cls.tile_cache[key] = img
+            return img
+
         img = np.zeros(
             shape=(tile_size * subdivs, tile_size * subdivs, 3), dtype=np.uint8
         )
@@ -207,53 +236,99 @@ class DirectionlessGrid(Grid):
         agent_pos: tuple[int, int],
         agent_dir: int | None = None,
         highlight_mask: np.ndarray | None = None,
+        grayscale: bool = False,
     ) -> np.ndarray:
         """
         Render this grid at a given scale
         :param r: target renderer object
         :param tile_size: tile size in pixels
+        :param grayscale: assemble a (H, W) uint8 frame from grayscale tiles
+
+        Cells are encoded into an array of tile ids and the frame is assembled
+        with one gather from the stacked tiles; only the agent and
+        highlighted cells are drawn individually on top.
         """
 
-        if highlight_mask is None:
-            highlight_mask = np.zeros(shape=(self.width, self.height), dtype=bool)
-
-        # Compute the total grid size
-        width_px = self.width * tile_size
-        height_px = self.height * tile_size
-
-        img = np.zeros(shape=(height_px, width_px, 3), dtype=np.uint8)
-
-        # Render the grid
-        for j in range(0, self.height):
-            for i in range(0, self.width):
-                cell = self.get(i, j)
-
-                agent_here = np.array_equal(agent_pos, (i, j))
-                assert highlight_mask is not None
-
-                if (
-                    isinstance(cell, Goal)
-                    and cell.color == "green"
-                    and self.invisible_goal
-                ):
-                    cell = None
-                if isinstance(cell, Lava) and self.invisible_goal:
-                    cell = None
-                tile_img = DirectionlessGrid.render_tile(
-                    cell,
-                    agent_dir=agent_dir if agent_here else None,
-                    highlight=highlight_mask[i, j],
-                    tile_size=tile_size,
+        # Encode every cell as an index into `tiles`
+        tile_ids: dict[Any, int] = {}
+        tiles = []
+        ids = np.empty(self.width * self.height, dtype=np.intp)
+        for k, cell in enumerate(self.grid):
+            cell = self._visible(cell)
+            key = cell.encode() if cell else None
+            tile_id = tile_ids.get(key)
+            if tile_id is None:
+                tile_id = tile_ids[key] = len(tiles)
+                tiles.append(
+                    DirectionlessGrid.render_tile(
+                        cell, tile_size=tile_size, grayscale=grayscale
+                    )
                 )
+            ids[k] = tile_id
+
+        # Gather into (height, width, tile, tile[, 3]) and interleave the axes
+        tiles = np.stack(tiles).astype(np.uint8)
+        channels = tiles.shape[3:]
+        img = (
+            tiles[ids]
+            .reshape((self.height, self.width, tile_size, tile_size) + channels)
+            .swapaxes(1, 2)
+            .reshape((self.height * tile_size, self.width * tile_size) + channels)
+        )
+
+        overlays = set()
+        if highlight_mask is not None:
+            overlays.update(zip(*np.nonzero(highlight_mask)))
+        if agent_dir is not None:
+            overlays.add(tuple(int(v) for v in agent_pos))
+        for i, j in overlays:
+            if not (0 <= i < self.width and 0 <= j < self.height):
+                continue
+            agent_here = np.array_equal(agent_pos, (i, j))
+            img[
+                j * tile_size : (j + 1) * tile_size,
+                i * tile_size : (i + 1) * tile_size,
+            ] = DirectionlessGrid.render_tile(
+                self._visible(self.get(i, j)),
+                agent_dir=agent_dir if agent_here else None,
+                highlight=highlight_mask is not None and highlight_mask[i, j],
+                tile_size=tile_size,
+                grayscale=grayscale,
+            )
 
-                ymin = j * tile_size
-                ymax = (j + 1) * tile_size
-                xmin = i * tile_size
-                xmax = (i + 1) * tile_size
-                img[ymin:ymax, xmin:xmax, :] = tile_img
+        return img
 
+    def render_symbolic(self, agent_pos: tuple[int, int]) -> np.ndarray:
+        """
+        One-hot (height, width, NUM_TILE_KINDS + 1) grid of tile kinds with
+        the agent in the last plane. Set entries are 255 so the grid goes
+        through the same uint8 pipeline as images.
+        """
+        kinds = np.array(
+            [
+                OBJECT_KINDS[(cell.type, cell.color)] if cell else EMPTY
+                for cell in map(self._visible, self.grid)
+            ]
+        ).reshape(self.height, self.width)
+        img = np.zeros((self.height, self.width, NUM_TILE_KINDS + 1), dtype=np.uint8)
+        img[..., :NUM_TILE_KINDS] = 255 * (
+            kinds[..., None] == np.arange(NUM_TILE_KINDS)
+        )
+        img[agent_pos[1], agent_pos[0], NUM_TILE_KINDS] = 255
         return img
 
+    def _visible(self, cell: WorldObj | None) -> WorldObj | None:
+        """
+        The object drawn for a cell, hiding the goal and lava if requested
+        """
+        if not self.invisible_goal:
+            return cell
+        if isinstance(cell, Goal) and cell.color == "green":
+            return None
+        if isinstance(cell, Lava):
+            return None
+        return cell
+
 
 class ImgObsPositionWrapper(gym.ObservationWrapper):
     """
@@ -285,6 +360,106 @@ class ImgObsPositionWrapper(gym.ObservationWrapper):
         return obs["image"], obs
 
 
+class GrayscaleImgObsWrapper(gym.ObservationWrapper):
+    """
+    Same observations as `RGBImgObsWrapper` followed by `GrayscaleObservation`,
+    rendered directly from cached grayscale tiles without an RGB frame
+    """
+
+    def __init__(self, env, tile_size: int = 8):
+        super().__init__(env)
+        self.tile_size = tile_size
+
+        new_image_space = spaces.Box(
+            low=0,
+            high=255,
+            shape=(
+                self.unwrapped.height * tile_size,
+                self.unwrapped.width * tile_size,
+            ),
+            dtype="uint8",
+        )
+        self.observation_space = spaces.Dict(
+            {**self.observation_space.spaces, "image": new_image_space}
+        )
+
+    def render_frame(self) -> np.ndarray:
+        env = self.unwrapped
+        return env.grid.render(
+            self.tile_size, env.agent_pos, env.agent_dir, grayscale=True
+        )
+
+    def observation(self, obs):
+        return {**obs, "image": self.render_frame()}
+
+
+class SymbolicObsWrapper(gym.ObservationWrapper):
+    """
+    Replace the image with the one-hot tile-kind grid from
+    `DirectionlessGrid.render_symbolic`, one cell per grid square
+    """
+
+    def __init__(self, env):
+        super().__init__(env)
+        new_image_space = spaces.Box(
+            low=0,
+            high=255,
+            shape=(self.unwrapped.height, self.unwrapped.width, NUM_TILE_KINDS + 1),
+            dtype="uint8",
+        )
+        self.observation_space = spaces.Dict(
+            {**self.observation_space.spaces, "image": new_image_space}
+        )
+
+    def observation(self, obs):
+        env = self.unwrapped
+        return {**obs, "image": env.grid.render_symbolic(env.agent_pos)}
+
+
+class CachedGrayscaleImgObsWrapper(GrayscaleImgObsWrapper):
+    """
+    `GrayscaleImgObsWrapper` memoized on the TMaze state that determines the
+    frame.
+
+    The full frame only depends on the agent position and direction, the goal
+    side, the grey-box hint mask and `invisible_goal`, so it is rendered once
+    per distinct state and then served from a bounded LRU cache. Cached frames
+    are read-only and shared between steps.
+    """
+
+    def __init__(self, env, tile_size: int = 8, max_size: int = 1024):
+        super().__init__(env, tile_size)
+        self.max_size = max_size
+        self.cache: collections.OrderedDict[tuple, np.ndarray] = (
+            collections.OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def observation(self, obs):
+        env = self.unwrapped
+        key = (
+            tuple(int(v) for v in env.agent_pos),
+            int(env.agent_dir),
+            tuple(int(v) for v in env.goal_position),
+            env.hint_mask,
+            env.invisible_goal,
+        )
+        frame = self.cache.get(key)
+        if frame is None:
+            self.misses += 1
+            frame = self.render_frame()
+            frame.setflags(write=False)
+            self.cache[key] = frame
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+
+        return {**obs, "image": frame}
+
+
 class Actions(IntEnum):
     left = 0
     forward = 1
@@ -388,6 +563,17 @@ class TMaze(MiniGridEnv):
             **kwargs,
         )
         self.actions = Actions
+        # Grey hint boxes left, right, above and below the hint room centre.
+        # `hint_mask` mirrors which of them are currently in the grid so
+        # `gen_obs` only touches cells whose state changes.
+        self.hint_positions = (
+            (self.width * 3 // 4 - 1, self.height * 2 // 3 - 1),
+            (self.width * 3 // 4 + 1, self.height * 2 // 3 - 1),
+            (self.width * 3 // 4, self.height * 2 // 3 - 2),
+            (self.width * 3 // 4, self.height * 2 // 3),
+        )
+        self.hint_box = Goal("grey")
+        self.hint_mask = (False,) * len(self.hint_positions)
         image_observation_space = gym.spaces.Box(
             low=0,
             high=255,
@@ -428,6 +614,7 @@ class TMaze(MiniGridEnv):
 
         # Create an empty grid
         self.grid = DirectionlessGrid(width, height, invisible_goal=self.invisible_goal)
+        self.hint_mask = (False,) * len(self.hint_positions)
 
         # Generate the surrounding walls
         self.grid.wall_rect(0, 0, width, height)
@@ -520,15 +707,6 @@ class TMaze(MiniGridEnv):
         """
         Generate the agent's view (partially observable, low-resolution encoding)
         """
-        grey_box = Goal("grey")
-        left_box = (self.width * 3 // 4 - 1, self.height * 2 // 3 - 1)
-        right_box = (self.width * 3 // 4 + 1, self.height * 2 // 3 - 1)
-        up_box = (self.width * 3 // 4, self.height * 2 // 3 - 2)
-        down_box = (self.width * 3 // 4, self.height * 2 // 3)
-        box_locations = [left_box, right_box, up_box, down_box]
-        for box in box_locations:
-            self.grid.set(box[0], box[1], None)
-
         goal_is_right = int(
             np.array_equal(self.goal_position, np.array((self.width - 2, 1)))
         )
@@ -537,17 +715,16 @@ class TMaze(MiniGridEnv):
         # else:
         #     maybe_goal_corner = np.random.randint(0, 2)
 
-        if self.agent_pos[1] == 1:
-            w, h = right_box if goal_is_right else left_box
-        else:
-            w, h = up_box
         if self.num_episodes > self.path_episode_threshold:
-            self.put_obj(grey_box, w, h)
+            # left/right box on the top row depending on the goal, up box otherwise
+            hint = (1 if goal_is_right else 0) if self.agent_pos[1] == 1 else 2
+            hint_mask = tuple(i == hint for i in range(len(self.hint_positions)))
         else:
             # Randomly decide whether to place box at selected location
-            for box in box_locations:
-                if self.np_random.random() < 0.5:
-                    self.put_obj(grey_box, box[0], box[1])
+            hint_mask = tuple(
+                bool(self.np_random.random() < 0.5) for _ in self.hint_positions
+            )
+        self._place_hints(hint_mask)
         grid, vis_mask = self.gen_obs_grid()
 
         # Encode the partially observable view into a numpy array
@@ -574,6 +751,20 @@ class TMaze(MiniGridEnv):
         }
         return obs
 
+    def _place_hints(self, hint_mask: tuple[bool, ...]):
+        """
+        Bring the grey hint boxes in the grid in line with `hint_mask`,
+        touching only the cells that change
+        """
+        if hint_mask == self.hint_mask:
+            return
+        for (w, h), placed, wanted in zip(
+            self.hint_positions, self.hint_mask, hint_mask
+        ):
+            if placed != wanted:
+                self.grid.set(w, h, self.hint_box if wanted else None)
+        self.hint_mask = hint_mask
+
     # Customized to remove highlight mask
     def get_full_render(self, highlight, tile_size):
         """
@@ -732,10 +923,34 @@ class Args:
     invisible_goal: bool = False
     num_envs: int = 1
     """the number of parallel game environments"""
+    async_envs: bool = False
+    """if toggled, the environments are stepped in subprocesses with `gym.vector.AsyncVectorEnv`"""
+    shared_memory_envs: bool = False
+    """if toggled, the environments are stepped in subprocesses that write observations into shared memory (`shm_vector_env`)"""
     buffer_size: int = 10000
     """the replay memory buffer size"""
+    dedup_frames: bool = False
+    """if toggled, the replay buffer stores ids into a table of unique frames instead of full images"""
+    frame_table_size: int = 4096
+    """the initial number of unique frames kept when `dedup_frames` is toggled; frames no replay row references are evicted, and the table grows if too few can be"""
+    obs_cache_size: int = 0
+    """if positive, rendered frames are memoized per TMaze state in an LRU cache of this many entries"""
+    tile_size: int = 8
+    """the number of pixels per grid cell in image observations"""
+    symbolic_obs: bool = False
+    """if toggled, observations are a one-hot grid of tile kinds (one cell per grid square) instead of an image"""
+    prioritized_replay: bool = False
+    """if toggled, transitions are sampled proportionally to their TD error from a sum-tree"""
+    prioritized_replay_alpha: float = 0.6
+    """the exponent applied to TD errors to get sampling priorities"""
+    prioritized_replay_beta: float = 0.4
+    """the initial importance-sampling exponent, annealed to 1 over `total-timesteps`"""
+    prioritized_replay_eps: float = 1e-6
+    """the constant added to TD errors so no transition has zero priority"""
     gamma: float = 0.99
     """the discount factor gamma"""
+    n_step: int = 1
+    """the number of steps summed into each replayed return before bootstrapping"""
     tau: float = 1.0
     """the target network update rate"""
     target_network_frequency: int = 500
@@ -752,26 +967,55 @@ class Args:
     """timestep to start learning"""
     train_frequency: int = 10
     """the frequency of training"""
+    updates_per_call: int = 1
+    """the number of gradient steps run inside one compiled call, every `train-frequency * updates-per-call` steps"""
+    gated_q: bool = False
+    """if toggled, the Q-network is `networks_jax.GatedDQN`, which runs the conv stack only on samples its arrow gate routes heavy"""
+    heavy_buckets: tuple[int, ...] = (16, 32, 64)
+    """the static sub-batch sizes heavy-routed samples are packed into when `gated-q` is toggled (the full batch is always one)"""
+    bf16: bool = False
+    """if toggled, the Q-network's conv and dense layers compute in bfloat16 (parameters, targets and the loss stay float32); only faster on accelerators with native bfloat16, XLA:CPU emulates it and trains slower than float32"""
+    on_device: bool = False
+    """if toggled, env stepping, replay and updates run inside a compiled `lax.scan` over the functional `tmaze_jax` env"""
+    scan_chunk_size: int = 1000
+    """with `on_device`, the most env steps per compiled call between training slots, and the logging interval"""
+
+
+def make_env(
+    env_id,
+    seed,
+    idx,
+    capture_video,
+    run_name,
+    invisible_goal,
+    obs_cache_size=0,
+    tile_size=8,
+    symbolic_obs=False,
+):
+    def image_observation(env):
+        if symbolic_obs:
+            return SymbolicObsWrapper(env)
+        if obs_cache_size > 0:
+            return CachedGrayscaleImgObsWrapper(
+                env, tile_size=tile_size, max_size=obs_cache_size
+            )
+        return GrayscaleImgObsWrapper(env, tile_size=tile_size)
 
-
-def make_env(env_id, seed, idx, capture_video, run_name, invisible_goal):
     def thunk():
-        if capture_video and idx == 1:
+        if capture_video and idx == 0:
             env = gym.make(
                 env_id, render_mode="rgb_array", invisible_goal=invisible_goal
             )
-            env = minigrid.wrappers.RGBImgObsWrapper(env)
-            env = GrayscaleObservation(env)
+            env = image_observation(env)
             env = gym.wrappers.RecordVideo(
                 env,
                 f"videos/{run_name}",
             )
         else:
-            env = gym.make(env_id)
-            env = minigrid.wrappers.RGBImgObsWrapper(env)
-            env = GrayscaleObservation(env)
+            env = gym.make(env_id, invisible_goal=invisible_goal)
+            env = image_observation(env)
+        env = gym.wrappers.FilterObservation(env, ["image", "arrow"])
         env = gym.wrappers.RecordEpisodeStatistics(env)
-        env = gym.wrappers.Autoreset(env)
         env.action_space.seed(seed)
 
         return env
@@ -803,17 +1047,7 @@ def linear_schedule(start_e: float, end_e: float, duration: int, t: int):
 
 
 if __name__ == "__main__":
-    import stable_baselines3 as sb3
-
-    if sb3.__version__ < "2.0":
-        raise ValueError(
-            """Ongoing migration: run the following command to install the new dependencies:
-
-poetry run pip install "stable_baselines3==2.0.0a1"
-"""
-        )
     args = tyro.cli(Args)
-    assert args.num_envs == 1, "vectorized envs are not supported at the moment"
     run_name = f"{args.env_id}__{args.exp_name}__seed_{args.seed}__{int(time.time())}__{args.experiment_description}__learning_rate_{args.learning_rate}"
     if args.track:
         import wandb
@@ -841,34 +1075,88 @@ poetry run pip install "stable_baselines3==2.0.0a1"
     key, q_key = jax.random.split(key, 2)
 
     # env setup
-    envs = make_env(
-        args.env_id, args.seed + 1, 1, args.capture_video, run_name, args.invisible_goal
-    )()
-    assert isinstance(
-        envs.action_space, gym.spaces.Discrete
-    ), "only discrete action space is supported"
-
-    obs, _ = envs.reset(seed=args.seed)
+    if args.on_device:
+        jax_env = TMazeJax(
+            invisible_goal=args.invisible_goal,
+            tile_size=args.tile_size,
+            symbolic=args.symbolic_obs,
+        )
+        key, reset_key = jax.random.split(key)
+        env_state, obs = jax.vmap(jax_env.reset)(
+            jax.random.split(reset_key, args.num_envs)
+        )
+        action_dim = jax_env.num_actions
+    else:
+        assert not (
+            args.async_envs and args.shared_memory_envs
+        ), "choose one of async_envs and shared_memory_envs"
+        env_fns = [
+            make_env(
+                args.env_id,
+                args.seed + i,
+                i,
+                args.capture_video,
+                run_name,
+                args.invisible_goal,
+                args.obs_cache_size,
+                args.tile_size,
+                args.symbolic_obs,
+            )
+            for i in range(args.num_envs)
+        ]
+        if args.shared_memory_envs:
+            # copies: `obs` is still read after the next `envs.step`, which
+            # overwrites the shared arrays
+            envs = SharedMemoryVectorEnv(env_fns, copy=True)
+        else:
+            vector_env_cls = (
+                gym.vector.AsyncVectorEnv
+                if args.async_envs
+                else gym.vector.SyncVectorEnv
+            )
+            envs = vector_env_cls(
+                env_fns, autoreset_mode=gym.vector.AutoresetMode.SAME_STEP
+            )
+        assert isinstance(
+            envs.single_action_space, gym.spaces.Discrete
+        ), "only discrete action space is supported"
+        envs.action_space.seed(args.seed)
+        obs, _ = envs.reset(seed=args.seed)
+        action_dim = envs.single_action_space.n
+
     import matplotlib.pyplot as plt
 
-    plt.imshow(obs["image"], cmap="gray")
+    image = obs["image"][0]
+    plt.imshow(image.argmax(-1) if args.symbolic_obs else image, cmap="gray")
     plt.savefig("obs_image.png")
     plt.close()
-    q_network = HeavyNet(
-        # obs_shape=envs.observation_space.shape,
-        action_dim=envs.action_space.n,
-    )
+    if args.bf16 and jax.default_backend() == "cpu":
+        warnings.warn(
+            "--bf16 on the CPU backend is slower than float32: XLA:CPU has no "
+            "native bfloat16 convolutions"
+        )
+    dtype = jnp.bfloat16 if args.bf16 else jnp.float32
+    if args.gated_q:
+        q_network = GatedDQN(
+            action_dim=action_dim, heavy_buckets=args.heavy_buckets, dtype=dtype
+        )
+    else:
+        q_network = HeavyNet(
+            # obs_shape=envs.observation_space.shape,
+            action_dim=action_dim,
+            dtype=dtype,
+        )
     q_state = TrainState.create(
         apply_fn=q_network.apply,
         params=q_network.init(
             q_key,
-            jnp.expand_dims(jnp.array(obs["image"]), 0),
-            jnp.expand_dims(jnp.array([obs["arrow"]]), 0),
+            jnp.array(obs["image"]),
+            jnp.array(obs["arrow"]),
         ),
         target_params=q_network.init(
             q_key,
-            jnp.expand_dims(jnp.array(obs["image"]), 0),
-            jnp.expand_dims(jnp.array([obs["arrow"]]), 0),
+            jnp.array(obs["image"]),
+            jnp.array(obs["arrow"]),
         ),
         tx=optax.adam(learning_rate=args.learning_rate),
     )
@@ -879,24 +1167,57 @@ poetry run pip install "stable_baselines3==2.0.0a1"
         sum(x.size for x in jax.tree.leaves(q_state.target_params)),
     )
 
+    # the Q-values that are differentiated; `GatedDQN` runs them densely
+    # (see its docstring)
+    q_train_apply = (
+        partial(q_network.apply, dense=True) if args.gated_q else q_network.apply
+    )
     q_network.apply = jax.jit(q_network.apply)
     # This step is not necessary as init called on same observation and key will always lead to same initializations
     q_state = q_state.replace(
         target_params=optax.incremental_update(q_state.params, q_state.target_params, 1)
     )
 
-    rb = DictReplayBuffer(
-        args.buffer_size,
-        gym.spaces.Dict(
-            {
-                "image": envs.observation_space["image"],
-                "arrow": envs.observation_space["arrow"],
-            }
-        ),
-        envs.action_space,
-        "cpu",
-        handle_timeout_termination=False,
+    assert not (
+        args.on_device and args.dedup_frames
+    ), "frame deduplication is only supported for host-side envs"
+    assert not (
+        args.on_device and args.n_step > 1
+    ), "n-step returns are only supported for host-side envs"
+    if args.dedup_frames:
+        # frames held between `intern` and `store` are pinned for the n-step
+        # window they can sit in before reaching the replay buffer
+        frame_table = FrameTable(
+            args.frame_table_size,
+            obs["image"].shape[1:],
+            args.buffer_size,
+            hold_steps=args.n_step,
+        )
+        image_example = jnp.zeros((), dtype=jnp.int32)
+    else:
+        image_example = obs["image"][0]
+    example = Transition(
+        image=image_example,
+        arrow=jnp.asarray(obs["arrow"][0], dtype=jnp.float32),
+        action=jnp.zeros((), dtype=jnp.int32),
+        reward=jnp.zeros((), dtype=jnp.float32),
+        done=jnp.zeros((), dtype=jnp.float32),
+        next_image=image_example,
+        next_arrow=jnp.asarray(obs["arrow"][0], dtype=jnp.float32),
+        discount=jnp.zeros((), dtype=jnp.float32),
     )
+    if args.prioritized_replay:
+        rb = PrioritizedReplayBuffer.create(
+            args.buffer_size,
+            example,
+            alpha=args.prioritized_replay_alpha,
+            eps=args.prioritized_replay_eps,
+        )
+    else:
+        rb = ReplayBuffer.create(args.buffer_size, example)
+    # Donating the buffer lets XLA write the new rows in place instead of
+    # copying the whole store on every host-side insert
+    rb_add = jax.jit(type(rb).add, donate_argnums=0)
 
     @jax.jit
     def update(
@@ -908,146 +1229,354 @@ poetry run pip install "stable_baselines3==2.0.0a1"
         next_arrows,
         rewards,
         dones,
+        discounts,
+        weights,
     ):
         q_next_target = q_network.apply(
             q_state.target_params, next_observations, next_arrows
         )  # (batch_size, num_actions)
         q_next_target = jnp.max(q_next_target, axis=-1)  # (batch_size,)
-        next_q_value = rewards + (1 - dones) * args.gamma * q_next_target
+        # `discounts` is gamma ** n for n-step transitions
+        next_q_value = rewards + (1 - dones) * discounts * q_next_target
 
         def mse_loss(params):
-            q_pred = q_network.apply(
+            q_pred = q_train_apply(
                 params, observations, arrows
             )  # (batch_size, num_actions)
             q_pred = q_pred[
                 jnp.arange(q_pred.shape[0]), actions.squeeze()
             ]  # (batch_size,)
-            return ((q_pred - next_q_value) ** 2).mean(), q_pred
+            td_error = q_pred - next_q_value
+            # importance-sampling weights are all ones without prioritized replay
+            return (weights * td_error**2).mean(), (q_pred, td_error)
 
-        (loss_value, q_pred), grads = jax.value_and_grad(mse_loss, has_aux=True)(
-            q_state.params
-        )
+        (loss_value, (q_pred, td_error)), grads = jax.value_and_grad(
+            mse_loss, has_aux=True
+        )(q_state.params)
         q_state = q_state.apply_gradients(grads=grads)
-        return loss_value, q_pred, q_state
+        return loss_value, q_pred, td_error, q_state
 
-    start_time = time.time()
-
-    # TRY NOT TO MODIFY: start the game
-    obs, _ = envs.reset(seed=args.seed)
+    def prioritized_replay_beta(global_step):
+        frac = global_step / args.total_timesteps
+        beta = args.prioritized_replay_beta
+        return jnp.minimum(beta + (1.0 - beta) * frac, 1.0)
 
-    terminations = np.array([False])
-    truncations = np.array([False])
-    seed = args.seed
-    for global_step in tqdm(range(args.total_timesteps)):
-        # ALGO LOGIC: put action logic here
-        epsilon = linear_schedule(
-            args.start_e,
-            args.end_e,
-            args.exploration_fraction * args.total_timesteps,
-            global_step,
-        )
-        if random.random() < epsilon:
-            actions = np.array([envs.action_space.sample() for _ in range(1)])
-        else:
-            q_values = q_network.apply(
-                q_state.params,
-                jnp.expand_dims(jnp.array(obs["image"]), 0),
-                jnp.expand_dims(jnp.array([obs["arrow"]]), 0),
+    def sample_and_update(q_state, rb, key, global_step, frames=None):
+        if args.prioritized_replay:
+            data, idx, weights = rb.sample_prioritized(
+                key, args.batch_size, prioritized_replay_beta(global_step)
             )
-            actions = q_values.argmax(axis=-1)
-            actions = jax.device_get(actions)
-
-        # TRY NOT TO MODIFY: execute the game and log data.
-        if terminations or truncations:
-            # key, new_key = jax.random.split(key)
-            # seed = int(jax.random.randint(new_key, (), 0, 2**30))
-            # rng = np.random.default_rng(np.asarray(new_key))
-            obs, _ = envs.reset()
-            terminations = np.array([False])
-            truncations = np.array([False])
         else:
-            next_obs, rewards, terminations, truncations, infos = envs.step(actions)
-        # next_obs = np.expand_dims(obs["image"], axis=0)
-        terminations = np.expand_dims(terminations, axis=0)
-        truncations = np.expand_dims(truncations, axis=0)
-
-        # TRY NOT TO MODIFY: record rewards for plotting purposes
-        if np.any(truncations) or np.any(terminations):
-            writer.add_scalar(
-                "charts/episodic_return", infos["episode"]["r"], global_step
+            data = rb.sample(key, args.batch_size)
+            weights = jnp.ones(args.batch_size)
+        if frames is not None:
+            # deduplicated storage: rows hold frame ids
+            data = data.replace(
+                image=frames[data.image], next_image=frames[data.next_image]
+            )
+        loss, q_pred, td_error, q_state = update(
+            q_state,
+            data.image,
+            data.arrow,
+            data.action,
+            data.next_image,
+            data.next_arrow,
+            data.reward,
+            data.done,
+            data.discount,
+            weights,
+        )
+        if args.prioritized_replay:
+            rb = rb.update_priorities(idx, td_error)
+        return loss, q_pred, q_state, rb
+
+    @partial(jax.jit, donate_argnums=1)
+    def train_updates(q_state, rb, key, global_step, frames=None):
+        """
+        Run `updates_per_call` gradient steps in one program, standing in for
+        the training slots `global_step - (K - 1) * train_frequency, ...,
+        global_step`. The target network is synced after the slot in which
+        a multiple of `target_network_frequency` was reached.
+
+        The K steps are unrolled at trace time rather than scanned: XLA:CPU
+        runs convolution gradients inside `lax.scan` / `lax.cond` bodies
+        about 50x slower than at the top level of a program.
+        """
+        losses, q_means = [], []
+        for k in range(args.updates_per_call):
+            step = global_step - (args.updates_per_call - 1 - k) * args.train_frequency
+            loss, q_pred, q_state, rb = sample_and_update(
+                q_state, rb, jax.random.fold_in(key, k), step, frames
             )
-            writer.add_scalar(
-                "charts/episodic_length", infos["episode"]["l"], global_step
+
+            # update target network
+            sync = (
+                step // args.target_network_frequency
+                > (step - args.train_frequency) // args.target_network_frequency
             )
-            # if "final_info" in infos:
-            #     for info in infos["final_info"]:
-            #         if info and "episode" in info:
-            #         print(
-            #             f"global_step={global_step}, episodic_return={info['episode']['r']}"
-            #         )
-            #         writer.add_scalar(
-            #             "charts/episodic_return", info["episode"]["r"], global_step
-            #         )
-            #         writer.add_scalar(
-            #             "charts/episodic_length", info["episode"]["l"], global_step
-            #         )
-
-        # TRY NOT TO MODIFY: save data to reply buffer; handle `final_observation`
-        real_next_obs = next_obs.copy()
-        # for idx, trunc in enumerate(truncations):
-        #     if trunc:
-        #         import pdb
-
-        #         pdb.set_trace()
-        #         real_next_obs[idx] = infos["final_observation"][idx]
-        rb.add(
-            {"image": obs["image"], "arrow": obs["arrow"]},
-            {"image": real_next_obs["image"], "arrow": real_next_obs["arrow"]},
-            actions,
-            rewards,
-            terminations,
-            infos,
+            q_state = q_state.replace(
+                target_params=jax.tree.map(
+                    lambda new, old: jnp.where(sync, new, old),
+                    optax.incremental_update(
+                        q_state.params, q_state.target_params, args.tau
+                    ),
+                    q_state.target_params,
+                )
+            )
+            losses.append(loss)
+            q_means.append(q_pred.mean())
+        return jnp.mean(jnp.stack(losses)), jnp.mean(jnp.stack(q_means)), q_state, rb
+
+    def on_device_step(carry, _):
+        q_state, rb, env_state, obs, episode_return, key, global_step = carry
+        key, explore_key, action_key = jax.random.split(key, 3)
+
+        # ALGO LOGIC: put action logic here
+        # `linear_schedule` with a traceable maximum, as `global_step` is traced
+        slope = (args.end_e - args.start_e) / (
+            args.exploration_fraction * args.total_timesteps
+        )
+        epsilon = jnp.maximum(slope * global_step + args.start_e, args.end_e)
+        q_values = q_network.apply(q_state.params, obs["image"], obs["arrow"])
+        actions = jnp.where(
+            jax.random.uniform(explore_key, (args.num_envs,)) < epsilon,
+            jax.random.randint(action_key, (args.num_envs,), 0, action_dim),
+            q_values.argmax(axis=-1),
+        )
+
+        env_state_before = env_state
+        env_state, next_obs, rewards, terminations, truncations, final_obs = jax.vmap(
+            jax_env.autoreset_step
+        )(env_state, actions)
+        dones = terminations | truncations
+        episode_return = episode_return + rewards
+
+        rb = rb.add(
+            Transition(
+                image=obs["image"],
+                arrow=obs["arrow"],
+                action=actions,
+                reward=rewards,
+                done=terminations,
+                next_image=final_obs["image"],
+                next_arrow=final_obs["arrow"],
+                discount=jnp.full(args.num_envs, args.gamma),
+            )
+        )
+
+        metrics = {
+            "episodes": dones.sum(),
+            "episodic_return": jnp.where(dones, episode_return, 0.0).sum(),
+            "episodic_length": jnp.where(
+                dones, env_state_before.step_count + 1, 0
+            ).sum(),
+        }
+        episode_return = jnp.where(dones, 0.0, episode_return)
+        carry = (q_state, rb, env_state, next_obs, episode_return, key, global_step + 1)
+        return carry, metrics
+
+    @partial(jax.jit, static_argnums=1, donate_argnums=0)
+    def on_device_collect(carry, num_steps: int):
+        return jax.lax.scan(on_device_step, carry, length=num_steps)
+
+    @partial(jax.jit, donate_argnums=0)
+    def on_device_train_round(carry):
+        """
+        The env step of a training slot, its `updates_per_call` updates and
+        the env steps up to the next slot. The updates are kept out of
+        `lax.scan` for the reason given in `train_updates`.
+        """
+        period = args.train_frequency * args.updates_per_call
+        carry, first = on_device_step(carry, None)
+        q_state, rb, env_state, obs, episode_return, key, global_step = carry
+        key, sample_key = jax.random.split(key)
+        loss, q_mean, q_state, rb = train_updates(
+            q_state, rb, sample_key, global_step - 1
+        )
+        carry = (q_state, rb, env_state, obs, episode_return, key, global_step)
+        carry, rest = jax.lax.scan(on_device_step, carry, length=period - 1)
+        metrics = jax.tree.map(
+            lambda x, xs: jnp.concatenate([x[None], xs]), first, rest
+        )
+        return carry, metrics, loss, q_mean
+
+    start_time = time.time()
+
+    if args.on_device:
+        carry = (
+            q_state,
+            rb,
+            env_state,
+            obs,
+            jnp.zeros(args.num_envs),
+            key,
+            jnp.zeros((), dtype=jnp.int32),
         )
-        # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
-        obs = next_obs
-
-        # ALGO LOGIC: training.
-        if global_step > args.learning_starts:
-            if global_step % args.train_frequency == 0:
-                data = rb.sample(args.batch_size)
-                # perform a gradient-descent step
-                loss, old_val, q_state = update(
-                    q_state,
-                    data.observations["image"].numpy(),
-                    data.observations["arrow"].numpy(),
-                    data.actions.numpy(),
-                    data.next_observations["image"].numpy(),
-                    data.next_observations["arrow"].numpy(),
-                    data.rewards.flatten().numpy(),
-                    data.dones.flatten().numpy(),
+        period = args.train_frequency * args.updates_per_call
+        global_step = 0
+        pending, losses = [], []  # device results since the last log write
+        progress = tqdm(total=args.total_timesteps)
+        while global_step < args.total_timesteps:
+            remaining = args.total_timesteps - global_step
+            if (
+                global_step > args.learning_starts
+                and global_step % period == 0
+                and remaining >= period
+            ):
+                carry, metrics, loss, q_mean = on_device_train_round(carry)
+                losses.append((loss, q_mean))
+                num_steps = period
+            else:
+                # env steps only, up to the next training slot
+                next_slot = max(global_step + 1, args.learning_starts + 1)
+                next_slot += -next_slot % period
+                num_steps = min(
+                    args.scan_chunk_size, remaining, next_slot - global_step
+                )
+                carry, metrics = on_device_collect(carry, num_steps)
+            pending.append(metrics)
+            previous_step, global_step = global_step, global_step + num_steps
+            progress.update(num_steps)
+            if (
+                global_step // args.scan_chunk_size
+                == previous_step // args.scan_chunk_size
+                and global_step < args.total_timesteps
+            ):
+                continue
+
+            metrics = jax.device_get(pending)
+            episodes = sum(m["episodes"].sum() for m in metrics)
+            if episodes > 0:
+                writer.add_scalar(
+                    "charts/episodic_return",
+                    sum(m["episodic_return"].sum() for m in metrics) / episodes,
+                    global_step,
+                )
+                writer.add_scalar(
+                    "charts/episodic_length",
+                    sum(m["episodic_length"].sum() for m in metrics) / episodes,
+                    global_step,
+                )
+            if losses:
+                loss, q_mean = np.mean(jax.device_get(losses), axis=0)
+                writer.add_scalar("losses/td_loss", loss, global_step)
+                writer.add_scalar("losses/q_values", q_mean, global_step)
+            pending, losses = [], []
+            sps = int(global_step * args.num_envs / (time.time() - start_time))
+            print("SPS:", sps)
+            writer.add_scalar("charts/SPS", sps, global_step)
+        progress.close()
+        q_state = carry[0]
+
+    else:
+        if args.n_step > 1:
+            n_step_buffer = NStepBuffer(args.n_step, args.gamma, args.num_envs)
+
+        # TRY NOT TO MODIFY: start the game
+        obs, _ = envs.reset(seed=args.seed)
+        # what the replay buffer stores for `obs`: the frames or their ids
+        image = (
+            frame_table.intern(obs["image"], 0) if args.dedup_frames else obs["image"]
+        )
+        for global_step in tqdm(range(args.total_timesteps)):
+            # ALGO LOGIC: put action logic here
+            epsilon = linear_schedule(
+                args.start_e,
+                args.end_e,
+                args.exploration_fraction * args.total_timesteps,
+                global_step,
+            )
+            actions = envs.action_space.sample()
+            greedy = np.random.random(args.num_envs) >= epsilon
+            if greedy.any():
+                q_values = q_network.apply(q_state.params, obs["image"], obs["arrow"])
+                actions = np.where(
+                    greedy, jax.device_get(q_values.argmax(axis=-1)), actions
                 )
 
-                if global_step % 100 == 0:
+            # TRY NOT TO MODIFY: execute the game and log data.
+            next_obs, rewards, terminations, truncations, infos = envs.step(actions)
+
+            # TRY NOT TO MODIFY: record rewards for plotting purposes
+            if "final_info" in infos and "episode" in infos["final_info"]:
+                episode = infos["final_info"]["episode"]
+                for idx in np.flatnonzero(infos["final_info"]["_episode"]):
                     writer.add_scalar(
-                        "losses/td_loss", jax.device_get(loss), global_step
+                        "charts/episodic_return", episode["r"][idx], global_step
                     )
                     writer.add_scalar(
-                        "losses/q_values", jax.device_get(old_val).mean(), global_step
-                    )
-                    print("SPS:", int(global_step / (time.time() - start_time)))
-                    writer.add_scalar(
-                        "charts/SPS",
-                        int(global_step / (time.time() - start_time)),
-                        global_step,
+                        "charts/episodic_length", episode["l"][idx], global_step
                     )
 
-            # update target network
-            if global_step % args.target_network_frequency == 0:
-                q_state = q_state.replace(
-                    target_params=optax.incremental_update(
-                        q_state.params, q_state.target_params, args.tau
+            # TRY NOT TO MODIFY: save data to reply buffer; handle `final_obs`
+            real_next_obs = {
+                "image": next_obs["image"].copy(),
+                "arrow": next_obs["arrow"].copy(),
+            }
+            if "final_obs" in infos:
+                for idx in np.flatnonzero(infos["_final_obs"]):
+                    real_next_obs["image"][idx] = infos["final_obs"][idx]["image"]
+                    real_next_obs["arrow"][idx] = infos["final_obs"][idx]["arrow"]
+            if args.dedup_frames:
+                # the ids of `next_obs` are reused as the next step's `obs`
+                next_image = frame_table.intern(next_obs["image"], global_step)
+                real_next_image = next_image.copy()
+                if "final_obs" in infos:
+                    final_idx = np.flatnonzero(infos["_final_obs"])
+                    real_next_image[final_idx] = frame_table.intern(
+                        real_next_obs["image"][final_idx], global_step
                     )
+            else:
+                next_image = next_obs["image"]
+                real_next_image = real_next_obs["image"]
+            transitions = Transition(
+                image=image,
+                arrow=obs["arrow"],
+                action=actions,
+                reward=rewards,
+                done=terminations,
+                next_image=real_next_image,
+                next_arrow=real_next_obs["arrow"],
+                discount=np.full(args.num_envs, args.gamma),
+            )
+            if args.n_step > 1:
+                transitions = n_step_buffer.push(
+                    transitions, np.logical_or(terminations, truncations)
                 )
+            if transitions is not None:
+                rb = rb_add(rb, transitions)
+                if args.dedup_frames:
+                    frame_table.store(transitions.image, transitions.next_image)
+            # TRY NOT TO MODIFY: CRUCIAL step easy to overlook
+            obs = next_obs
+            image = next_image
+
+            # ALGO LOGIC: training.
+            if global_step > args.learning_starts:
+                if global_step % (args.train_frequency * args.updates_per_call) == 0:
+                    # perform `updates_per_call` gradient-descent steps, syncing
+                    # the target network in-graph
+                    key, sample_key = jax.random.split(key)
+                    loss, q_mean, q_state, rb = train_updates(
+                        q_state,
+                        rb,
+                        sample_key,
+                        global_step,
+                        frame_table.frames if args.dedup_frames else None,
+                    )
+
+                    if global_step % 100 == 0:
+                        writer.add_scalar(
+                            "losses/td_loss", jax.device_get(loss), global_step
+                        )
+                        writer.add_scalar(
+                            "losses/q_values", jax.device_get(q_mean), global_step
+                        )
+                        sps = int(
+                            global_step * args.num_envs / (time.time() - start_time)
+                        )
+                        print("SPS:", sps)
+                        writer.add_scalar("charts/SPS", sps, global_step)
 
     if args.save_model:
         model_path = f"runs/{run_name}/{args.exp_name}.cleanrl_model"
@@ -1082,5 +1611,6 @@ poetry run pip install "stable_baselines3==2.0.0a1"
                 f"videos/{run_name}-eval",
             )
 
-    envs.close()
+    if not args.on_device:
+        envs.close()
     writer.close()
@@ -1,3 +1,7 @@
+import time
+import warnings
+from dataclasses import dataclass
+
 import torch
 import torch.nn as nn
 from torch.distributions.categorical import Categorical
@@ -10,6 +14,66 @@ def layer_init(layer, std=np.sqrt(2), bias_const=0.0):
     return layer
 
 
+def count_flops(module: nn.Module, *example_inputs) -> int:
+    """
+    Analytical FLOPs of one forward pass per sample: 2 * multiply-accumulates
+    of every Conv2d and Linear layer, read off the shapes they see during a
+    forward on `example_inputs` (a batch of one)
+    """
+    flops = 0
+
+    def hook(layer, inputs, output):
+        nonlocal flops
+        if isinstance(layer, nn.Conv2d):
+            kernel = layer.kernel_size[0] * layer.kernel_size[1]
+            flops += 2 * layer.in_channels // layer.groups * kernel * output.numel()
+        else:
+            flops += 2 * layer.in_features * output.numel()
+
+    handles = [
+        layer.register_forward_hook(hook)
+        for layer in module.modules()
+        if isinstance(layer, (nn.Conv2d, nn.Linear))
+    ]
+    try:
+        with torch.no_grad():
+            module(*example_inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return flops
+
+
+@dataclass
+class DispatchStats:
+    """
+    What one `GatedAgent._run_branch` call computed
+    """
+
+    batch_size: int
+    num_cheap: int
+    flops: int  # gate + the experts that actually ran
+    dense_flops: int  # gate + HeavyNet on the whole batch
+    # seconds, None unless `_run_branch` ran with `GatedAgent.time_branches`
+    # (the fused forward runs both experts in one graph and is never timed)
+    cheap_time: float | None
+    heavy_time: float | None
+    # the whole dispatch: gathers, both experts and the stitched outputs
+    dispatch_time: float | None = None
+
+    @property
+    def num_heavy(self) -> int:
+        return self.batch_size - self.num_cheap
+
+    @property
+    def flops_saved(self) -> int:
+        return self.dense_flops - self.flops
+
+    @property
+    def timed(self) -> bool:
+        return self.cheap_time is not None
+
+
 # ------------------------------------------------------------------
 # Replace the old Gate with a differentiable straight-through gate
 # ------------------------------------------------------------------
@@ -31,8 +95,8 @@ class DiffGate(nn.Module):
             layer_init(nn.Linear(7 * 7 * 4, 2), std=1),
         )
 
-    def forward(self, x, action=False):
-        logits = self.net(x.permute(0, 3, 1, 2)).squeeze(-1)
+    def forward(self, x, arrow=None, action=False):
+        logits = self.net(x.permute(0, 3, 1, 2).float()).squeeze(-1)
 
         categorization = nn.functional.gumbel_softmax(logits)
         return categorization[:, -1]
@@ -72,8 +136,8 @@ class HeavyNet(nn.Module):
         self.critic = layer_init(nn.Linear(64, 1), std=1)
 
     def forward(self, x):
-        # x: (B,7,7,3)
-        x = x.permute(0, 3, 1, 2)  # to NCHW
+        # x: (B,7,7,3), uint8 or float
+        x = x.permute(0, 3, 1, 2).float()  # to NCHW
         feat = self.network(x)
         logits = self.actor(feat)
         value = self.critic(feat)
@@ -113,34 +177,197 @@ class HeavyNet(nn.Module):
 class GatedAgent(nn.Module):
     def __init__(self, envs, compute_penalty=0.003):
         super().__init__()
-        self.cheap = CheapNet(envs.observation_space, envs.action_space.n)
-        self.heavy = HeavyNet(envs.action_space.n)
+        self.cheap = CheapNet(envs.single_observation_space, envs.single_action_space.n)
+        self.heavy = HeavyNet(envs.single_action_space.n)
         self.gate = DiffGate()
 
+        # per-sample FLOPs of each module, for dispatch accounting
+        image = torch.zeros((1,) + envs.single_observation_space["image"].shape)
+        arrow = torch.zeros((1,) + envs.single_observation_space["arrow"].shape)
+        self.flops = {
+            "gate": count_flops(self.gate, image, arrow),
+            "cheap": count_flops(self.cheap, image, arrow),
+            "heavy": count_flops(self.heavy, image),
+        }
+        # synchronize and time each expert call (adds a device sync on GPU)
+        self.time_branches = False
+        # e.g. torch.bfloat16: experts run under autocast with float32
+        # weights and return float32 outputs, so losses stay float32
+        self.autocast_dtype: torch.dtype | None = None
+        # set by `use_fused_forward`
+        self._fused_forward = None
+        self.last_dispatch: DispatchStats | None = None
+
+    def _forward(self, expert, *inputs):
+        if self.autocast_dtype is None:
+            return expert(*inputs)
+        with torch.autocast(inputs[0].device.type, dtype=self.autocast_dtype):
+            logits, value = expert(*inputs)
+        return logits.float(), value.float()
+
+    def _clock(self, x, force: bool = False):
+        """
+        `time.perf_counter()` after the pending work on `x`'s device, or
+        None when branches aren't timed
+        """
+        if not (self.time_branches or force):
+            return None
+        if x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        return time.perf_counter()
+
+    def _timed(self, expert, *inputs):
+        start = self._clock(inputs[0])
+        out = self._forward(expert, *inputs)
+        if start is None:
+            return out, None
+        return out, self._clock(inputs[0]) - start
+
     # --------------- helper: split forward through the two experts ------------
     def _run_branch(self, cheap_mask, obs, arrow):
         """
         cheap_mask ∈ {0,1}^B   1 → run cheap ;  0 → run heavy
         Only the selected branch is actually executed ⇒ ∆ compute!
+        Each expert runs once on its gathered sub-batch and the results are
+        copied into place; `self.last_dispatch` records the cost.
         Returns: (logits,value)
         """
-        if cheap_mask.all():
-            return self.cheap(obs, arrow)
-        if (~cheap_mask).all():
-            return self.heavy(obs)
-
-        # Mixed batch - do them separately and stitch together
-        logits = torch.zeros(
-            (obs.size(0), self.cheap.actor.out_features), device=obs.device
-        )
-        values = torch.zeros(obs.size(0), 1, device=obs.device)
-
+        batch_size = obs.size(0)
         idx_c = cheap_mask.nonzero(as_tuple=True)[0]
         idx_h = (~cheap_mask).nonzero(as_tuple=True)[0]
-        logits[idx_c], values[idx_c] = self.cheap(obs[idx_c])
-        logits[idx_h], values[idx_h] = self.heavy(obs[idx_h])
+        num_cheap = idx_c.numel()
+        # an expert that gets no rows took 0s; None means nothing was timed
+        cheap_time = heavy_time = 0.0 if self.time_branches else None
+        start = self._clock(obs)
+
+        if num_cheap == batch_size:
+            (logits, values), cheap_time = self._timed(self.cheap, obs, arrow)
+        elif num_cheap == 0:
+            (logits, values), heavy_time = self._timed(self.heavy, obs)
+        else:
+            # Mixed batch - gather each expert's rows and stitch the outputs
+            (logits_c, values_c), cheap_time = self._timed(
+                self.cheap, obs.index_select(0, idx_c), arrow.index_select(0, idx_c)
+            )
+            (logits_h, values_h), heavy_time = self._timed(
+                self.heavy, obs.index_select(0, idx_h)
+            )
+            logits = (
+                logits_h.new_empty((batch_size, logits_h.size(1)))
+                .index_copy_(0, idx_c, logits_c.to(logits_h.dtype))
+                .index_copy_(0, idx_h, logits_h)
+            )
+            values = (
+                values_h.new_empty((batch_size, 1))
+                .index_copy_(0, idx_c, values_c.to(values_h.dtype))
+                .index_copy_(0, idx_h, values_h)
+            )
+
+        self.last_dispatch = DispatchStats(
+            batch_size=batch_size,
+            num_cheap=num_cheap,
+            flops=batch_size * self.flops["gate"]
+            + num_cheap * self.flops["cheap"]
+            + (batch_size - num_cheap) * self.flops["heavy"],
+            dense_flops=batch_size * (self.flops["gate"] + self.flops["heavy"]),
+            cheap_time=cheap_time,
+            heavy_time=heavy_time,
+            dispatch_time=None if start is None else self._clock(obs) - start,
+        )
+        self._last_obs = obs
         return logits, values
 
+    def time_dense(self, obs, repeats: int = 3) -> float:
+        """
+        Seconds HeavyNet takes on every row of `obs`, the cost the gate saves
+        against (median of `repeats` synchronized runs)
+        """
+        times = []
+        with torch.no_grad():
+            for _ in range(repeats):
+                start = self._clock(obs, force=True)
+                self._forward(self.heavy, obs)
+                times.append(self._clock(obs, force=True) - start)
+        return float(np.median(times))
+
+    # --------------- fused forward for torch.compile --------------------------
+    def use_fused_forward(self, compile: bool = True):
+        """
+        Serve `get_action_and_value` from `_fused`, compiled with
+        `torch.compile(dynamic=False)` (one graph per batch size) unless
+        `compile` is False or compilation is unavailable, in which case the
+        same function runs eagerly
+        """
+        self._fused_forward = self._fused
+        if compile and hasattr(torch, "compile"):
+            self._fused_forward = torch.compile(
+                self._fused, dynamic=False, fullgraph=True
+            )
+
+    def _fused(self, x, arrow, action=None):
+        """
+        Gate, both experts, routing and sampling as one static-shape graph:
+        every sample runs both experts and `torch.where` keeps the routed
+        one, which beats gathering sub-batches at rollout batch sizes.
+        Actions are sampled with the Gumbel-max trick, which draws from the
+        same distribution as `Categorical(logits=logits).sample()`.
+        """
+        p_cheap = self.gate(x, arrow, action=True)
+        cheap_mask = p_cheap > 0.5
+        logits_c, value_c = self._forward(self.cheap, x, arrow)
+        logits_h, value_h = self._forward(self.heavy, x)
+        logits = torch.where(cheap_mask[:, None], logits_c, logits_h)
+        value = torch.where(cheap_mask[:, None], value_c, value_h)
+
+        log_probs = logits.log_softmax(-1)
+        if action is None:
+            noise = torch.rand_like(logits).clamp_min(1e-20)
+            action = (logits - torch.log(-torch.log(noise))).argmax(-1)
+        logp_gate, entropy_gate = self._gate_terms(p_cheap, cheap_mask)
+        logp = log_probs.gather(1, action.long()[:, None])[:, 0] + logp_gate
+        entropy = -(log_probs.exp() * log_probs).sum(-1) + entropy_gate
+        return action, logp, entropy, value, cheap_mask, p_cheap
+
+    def _run_fused(self, x, arrow, action):
+        try:
+            out = self._fused_forward(x, arrow, action)
+        except Exception as e:
+            if self._fused_forward == self._fused:
+                raise
+            warnings.warn(f"torch.compile failed, running eagerly: {e}")
+            self._fused_forward = self._fused
+            out = self._fused(x, arrow, action)
+        action, logp, entropy, value, cheap_mask, p_cheap = out
+
+        # both experts ran on the whole batch, inside one graph that cannot be
+        # split into per-expert timings
+        batch_size = x.size(0)
+        self.last_dispatch = DispatchStats(
+            batch_size=batch_size,
+            num_cheap=int(cheap_mask.sum()),
+            flops=batch_size * sum(self.flops.values()),
+            dense_flops=batch_size * (self.flops["gate"] + self.flops["heavy"]),
+            cheap_time=None,
+            heavy_time=None,
+        )
+        self._last_gate = cheap_mask.float()
+        self._last_p_cheap = p_cheap.detach()
+        return action, logp, entropy, value
+
+    @staticmethod
+    def _gate_terms(p_cheap, cheap_mask):
+        """
+        Log-prob of the hard gate decision and the gate's entropy
+        """
+        logp_gate = torch.where(
+            cheap_mask, torch.log(p_cheap + 1e-8), torch.log(1.0 - p_cheap + 1e-8)
+        )
+        entropy_gate = -(
+            p_cheap * torch.log(p_cheap + 1e-8)
+            + (1 - p_cheap) * torch.log(1 - p_cheap + 1e-8)
+        )
+        return logp_gate, entropy_gate
+
     # --------------- public API used by the PPO loop --------------------------
     def get_value(self, x, arrow):
         # Call gate once, create a hard mask, and run only the selected branch.
@@ -150,6 +377,9 @@ class GatedAgent(nn.Module):
         return self._run_branch(cheap_mask, x, arrow)[1]
 
     def get_action_and_value(self, x, arrow=None, action=None):
+        if self._fused_forward is not None:
+            return self._run_fused(x, arrow, action)
+
         # 1) Sample gate and turn it into a hard mask
 
         p_cheap = self.gate(x, arrow, action=True)  # (B,) - probability CHEAP
@@ -162,20 +392,188 @@ class GatedAgent(nn.Module):
         if action is None:
             action = dist.sample()
 
-        # add gate log-prob so PPO treats the gate as part of the policy
-        logp_gate = torch.where(
-            cheap_mask, torch.log(p_cheap + 1e-8), torch.log(1.0 - p_cheap + 1e-8)
-        )
-        logp = dist.log_prob(action) + logp_gate
-
+        # add gate log-prob so PPO treats the gate as part of the policy,
         # entropy = entropy(action) + entropy(gate)
-        entropy_gate = -(
-            p_cheap * torch.log(p_cheap + 1e-8)
-            + (1 - p_cheap) * torch.log(1 - p_cheap + 1e-8)
-        )
+        logp_gate, entropy_gate = self._gate_terms(p_cheap, cheap_mask)
+        logp = dist.log_prob(action) + logp_gate
         entropy = dist.entropy() + entropy_gate
 
         # For bookkeeping downstream (e.g. compute-penalty)
         self._last_gate = cheap_mask.float()
+        self._last_p_cheap = p_cheap.detach()
 
         return action, logp, entropy, value
+
+
+class ComputeMeter:
+    """
+    Accumulates the gate decisions and `DispatchStats` of a `GatedAgent`
+    between `write` calls and reports them as TensorBoard scalars and
+    histograms under `compute/`.
+
+    Call `record()` right after each `get_action_and_value` to be counted.
+    Latencies are only reported for steps timed by `agent.time_branches`,
+    which the fused forward of `use_fused_forward` never is. Those also get
+    the wall time the dispatch saves against HeavyNet on the whole batch,
+    timed on the last recorded batch at each `write`.
+    """
+
+    def __init__(self, agent: GatedAgent):
+        self.agent = agent
+        self.reset()
+
+    def reset(self):
+        self.p_cheap = []
+        self.cheap_fractions = []
+        self.num_samples = 0
+        self.num_cheap = 0
+        self.flops = 0
+        self.dense_flops = 0
+        self.timed_steps = 0
+        self.timed_cheap = 0
+        self.timed_heavy = 0
+        self.cheap_time = 0.0
+        self.heavy_time = 0.0
+        self.dispatch_time = 0.0
+        self.last_obs = None
+
+    def record(self):
+        stats = self.agent.last_dispatch
+        self.p_cheap.append(self.agent._last_p_cheap.cpu())
+        self.cheap_fractions.append(stats.num_cheap / stats.batch_size)
+        self.num_samples += stats.batch_size
+        self.num_cheap += stats.num_cheap
+        self.flops += stats.flops
+        self.dense_flops += stats.dense_flops
+        if stats.timed:
+            self.timed_steps += 1
+            self.timed_cheap += stats.num_cheap
+            self.timed_heavy += stats.num_heavy
+            self.cheap_time += stats.cheap_time
+            self.heavy_time += stats.heavy_time
+            self.dispatch_time += stats.dispatch_time
+            self.last_obs = self.agent._last_obs
+
+    def write(self, writer, global_step: int):
+        if self.num_samples == 0:
+            return
+        scalars = {
+            "cheap_fraction": self.num_cheap / self.num_samples,
+            "flops_per_sample": self.flops / self.num_samples,
+            "flops_saved_fraction": 1 - self.flops / self.dense_flops,
+            "gate_flops_per_sample": self.agent.flops["gate"],
+            "cheap_flops_per_sample": self.agent.flops["cheap"],
+            "heavy_flops_per_sample": self.agent.flops["heavy"],
+        }
+        if self.timed_steps:
+            scalars["cheap_time_per_step_ms"] = 1e3 * self.cheap_time / self.timed_steps
+            scalars["heavy_time_per_step_ms"] = 1e3 * self.heavy_time / self.timed_steps
+            if self.timed_cheap:
+                scalars["cheap_latency_per_sample_us"] = (
+                    1e6 * self.cheap_time / self.timed_cheap
+                )
+            if self.timed_heavy:
+                scalars["heavy_latency_per_sample_us"] = (
+                    1e6 * self.heavy_time / self.timed_heavy
+                )
+            # wall time against running HeavyNet on every row of a rollout batch
+            dispatch_time = self.dispatch_time / self.timed_steps
+            dense_time = self.agent.time_dense(self.last_obs)
+            scalars["dispatch_time_per_step_ms"] = 1e3 * dispatch_time
+            scalars["dense_heavy_time_per_step_ms"] = 1e3 * dense_time
+            scalars["time_saved_per_step_ms"] = 1e3 * (dense_time - dispatch_time)
+            scalars["time_saved_fraction"] = 1 - dispatch_time / dense_time
+        for name, value in scalars.items():
+            writer.add_scalar(f"compute/{name}", value, global_step)
+        writer.add_histogram("compute/p_cheap", torch.cat(self.p_cheap), global_step)
+        writer.add_histogram(
+            "compute/cheap_fraction_per_step",
+            np.array(self.cheap_fractions),
+            global_step,
+        )
+        self.reset()
+
+
+if __name__ == "__main__":
+    # Sparse dispatch vs always running HeavyNet on a TMaze-shaped batch
+    from types import SimpleNamespace
+
+    import gymnasium as gym
+
+    envs = SimpleNamespace(
+        single_observation_space=gym.spaces.Dict(
+            {
+                "image": gym.spaces.Box(0, 255, (7, 7, 3), np.uint8),
+                "arrow": gym.spaces.Box(0, 1, (1,), np.float32),
+            }
+        ),
+        single_action_space=gym.spaces.Discrete(4),
+    )
+    agent = GatedAgent(envs)
+    print("per-sample FLOPs:", agent.flops)
+
+    def wall_time(fn, repeats=20):
+        fn()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        return (time.perf_counter() - start) / repeats
+
+    with torch.no_grad():
+        for batch_size in (256, 4096):
+            obs = torch.randint(0, 11, (batch_size, 7, 7, 3), dtype=torch.uint8)
+            arrow = torch.rand(batch_size, 1)
+            dense = wall_time(lambda: agent.heavy(obs))
+            for cheap_fraction in (0.0, 0.5, 0.9, 1.0):
+                cheap_mask = torch.rand(batch_size) < cheap_fraction
+                sparse = wall_time(lambda: agent._run_branch(cheap_mask, obs, arrow))
+                stats = agent.last_dispatch
+                print(
+                    f"batch {batch_size:5d} cheap {stats.num_cheap / batch_size:4.0%}: "
+                    f"{stats.flops / 1e6:8.2f} MFLOPs vs {stats.dense_flops / 1e6:8.2f} "
+                    f"({stats.flops_saved / stats.dense_flops:4.0%} saved), "
+                    f"{sparse * 1e3:6.2f} ms vs {dense * 1e3:6.2f} ms heavy-only"
+                )
+
+    # PPO-style update throughput (forward, backward, Adam) in float32 and
+    # under bfloat16 autocast, with every sample routed to HeavyNet
+    batch_size = 256
+    obs = torch.randint(0, 11, (batch_size, 7, 7, 3), dtype=torch.uint8)
+    arrow = torch.rand(batch_size, 1)
+    heavy_mask = torch.zeros(batch_size, dtype=torch.bool)
+    optimizer = torch.optim.Adam(agent.parameters(), lr=1e-4)
+
+    def update():
+        logits, value = agent._run_branch(heavy_mask, obs, arrow)
+        loss = logits.logsumexp(-1).mean() + value.square().mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+    for autocast_dtype in (None, torch.bfloat16):
+        agent.autocast_dtype = autocast_dtype
+        seconds = wall_time(update)
+        print(
+            f"update {str(autocast_dtype or torch.float32):14s} batch {batch_size}: "
+            f"{seconds * 1e3:6.2f} ms, {batch_size / seconds:8.0f} samples/s"
+        )
+    agent.autocast_dtype = None
+
+    # per-step rollout latency of `get_action_and_value`: sparse dispatch,
+    # the fused forward run eagerly and the fused forward compiled
+    with torch.no_grad():
+        for name, fused, compile in (
+            ("dispatch", False, False),
+            ("fused eager", True, False),
+            ("fused compiled", True, True),
+        ):
+            agent._fused_forward = None
+            if fused:
+                agent.use_fused_forward(compile)
+            for batch_size in (1, 8, 64):
+                obs = torch.randint(0, 11, (batch_size, 7, 7, 3), dtype=torch.uint8)
+                arrow = torch.rand(batch_size, 1)
+                step = wall_time(
+                    lambda: agent.get_action_and_value(obs, arrow=arrow), repeats=200
+                )
+                print(f"{name:15s} batch {batch_size:3d}: {step * 1e6:8.1f} us/step")
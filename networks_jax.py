@@ -0,0 +1,249 @@
+"""
+Flax Q-networks for `main_dqn.py`, the JAX counterparts of the experts in
+`networks.py`.
+
+Every model is called as `model.apply(params, image, arrow)` with a batch of
+uint8 frames `(B, H, W)` or `(B, H, W, C)` and arrows `(B, num_actions)`, and
+returns Q-values `(B, action_dim)`.
+"""
+
+import flax.linen as nn
+import jax
+import jax.numpy as jnp
+
+
+class CheapNet(nn.Module):
+    "Arrow-only linear Q head; ignores the image"
+
+    action_dim: int
+
+    @nn.compact
+    def __call__(self, image: jax.Array, arrow: jax.Array):
+        return nn.Dense(self.action_dim)(arrow.astype(jnp.float32))
+
+
+class HeavyNet(nn.Module):
+    """
+    Conv Q-network over the full frame. The first conv has kernel and stride
+    equal to the tile size, so each grid cell becomes one feature vector
+    whatever the rendering resolution (including symbolic 1-cell tiles);
+    two 3x3 convs then mix neighbouring cells and the arrow joins before the
+    dense head.
+
+    `dtype` is the computation dtype of the conv and dense layers (e.g.
+    `jnp.bfloat16`); parameters and the returned Q-values stay float32.
+    bfloat16 only pays off on accelerators: XLA:CPU emulates it, and the
+    update benchmark below runs slower than in float32 there.
+    """
+
+    action_dim: int
+    grid_size: int = 11
+    dtype: jnp.dtype = jnp.float32
+
+    @nn.compact
+    def __call__(self, image: jax.Array, arrow: jax.Array):
+        x = image.astype(jnp.float32) / 255.0
+        if x.ndim == 3:
+            x = x[..., None]
+        tile = x.shape[1] // self.grid_size
+        assert x.shape[1] == x.shape[2] == tile * self.grid_size
+
+        x = nn.Conv(
+            32, kernel_size=(tile, tile), strides=(tile, tile), dtype=self.dtype
+        )(x)
+        x = nn.relu(x)
+        x = nn.Conv(64, kernel_size=(3, 3), dtype=self.dtype)(x)
+        x = nn.relu(x)
+        x = nn.Conv(64, kernel_size=(3, 3), dtype=self.dtype)(x)
+        x = nn.relu(x)
+        x = x.reshape((x.shape[0], -1))
+        x = jnp.concatenate([x, arrow.astype(x.dtype)], axis=-1)
+        x = nn.Dense(256, dtype=self.dtype)(x)
+        x = nn.relu(x)
+        return nn.Dense(self.action_dim, dtype=self.dtype)(x).astype(jnp.float32)
+
+
+class GatedDQN(nn.Module):
+    """
+    Per-sample routing between `CheapNet` and `HeavyNet` by a gate on the
+    arrow. The hard decision is `p_cheap > 0.5` with a straight-through
+    gradient into the gate. `p_cheap` is sown into the `intermediates`
+    collection for accounting.
+
+    Under `jax.jit` shapes are static, so heavy-routed samples are packed
+    into the smallest of the `heavy_buckets` sizes (plus 0 and the full
+    batch) that holds them, `nn.switch` runs `HeavyNet` on that bucket only
+    and the Q-values are scattered back. Each bucket size is compiled once.
+    With no buckets the conv stack is only skipped for all-cheap batches.
+    Cheap-routed samples get zero heavy Q-values, so the straight-through
+    gate gradient only sees the branch that actually ran.
+
+    `dense=True` runs `HeavyNet` on the whole batch instead, with the same
+    forward values. Use it for outputs that are differentiated: XLA:CPU
+    runs convolution gradients inside `nn.switch` branches about 25x
+    slower than outside control flow.
+    """
+
+    action_dim: int
+    grid_size: int = 11
+    heavy_buckets: tuple[int, ...] = ()
+    dtype: jnp.dtype = jnp.float32  # of the HeavyNet layers
+
+    @nn.compact
+    def __call__(self, image: jax.Array, arrow: jax.Array, dense: bool = False):
+        p_cheap = nn.sigmoid(nn.Dense(1, name="gate")(arrow.astype(jnp.float32)))[:, 0]
+        self.sow("intermediates", "p_cheap", p_cheap)
+        hard = (p_cheap > 0.5).astype(jnp.float32)
+        cheap_weight = (hard + p_cheap - jax.lax.stop_gradient(p_cheap))[:, None]
+
+        q_cheap = CheapNet(self.action_dim, name="cheap")(image, arrow)
+        heavy = HeavyNet(self.action_dim, self.grid_size, self.dtype, name="heavy")
+        if self.is_initializing() or dense:
+            q_heavy = heavy(image, arrow)
+        else:
+            q_heavy = self._bucketed(heavy, image, arrow, hard == 0)
+        return cheap_weight * q_cheap + (1 - cheap_weight) * q_heavy
+
+    def _bucketed(self, heavy, image, arrow, is_heavy):
+        batch_size = image.shape[0]
+        sizes = sorted(
+            {0, batch_size} | {min(s, batch_size) for s in self.heavy_buckets}
+        )
+        # heavy rows first; the padding index `batch_size` is clipped when
+        # gathering and dropped when scattering
+        rows = jnp.nonzero(is_heavy, size=batch_size, fill_value=batch_size)[0]
+        bucket = jnp.searchsorted(jnp.array(sizes), is_heavy.sum())
+
+        def run(size):
+            def branch(module, image, arrow, rows):
+                q = jnp.zeros((batch_size, self.action_dim), jnp.float32)
+                if size == 0:
+                    return q
+                rows = rows[:size]
+                q_rows = module(
+                    jnp.take(image, rows, axis=0, mode="clip"),
+                    jnp.take(arrow, rows, axis=0, mode="clip"),
+                )
+                return q.at[rows].set(q_rows, mode="drop")
+
+            return branch
+
+        return nn.switch(
+            bucket, [run(size) for size in sizes], heavy, image, arrow, rows
+        )
+
+
+if __name__ == "__main__":
+    # Parameters, compiled FLOPs and latency of each model on TMaze frames
+    import time
+
+    import numpy as np
+
+    def flops_of(fn, *inputs):
+        cost = jax.jit(fn).lower(*inputs).compile().cost_analysis()
+        if isinstance(cost, (list, tuple)):
+            cost = cost[0]
+        return cost.get("flops", float("nan"))
+
+    def latency(fn, *inputs, repeats=50):
+        fn = jax.jit(fn)
+        jax.block_until_ready(fn(*inputs))
+        start = time.perf_counter()
+        for _ in range(repeats):
+            jax.block_until_ready(fn(*inputs))
+        return (time.perf_counter() - start) / repeats
+
+    batch_size = 256
+    rng = np.random.default_rng(0)
+    for image_shape in ((88, 88), (11, 11, 6)):
+        image = rng.integers(0, 256, (batch_size,) + image_shape, dtype=np.uint8)
+        arrow = rng.uniform(-1, 1, (batch_size, 4)).astype(np.float32)
+        print(f"image {image_shape}, batch {batch_size}")
+        for model in (CheapNet(4), HeavyNet(4), GatedDQN(4)):
+            params = model.init(jax.random.PRNGKey(0), image, arrow)
+            num_params = sum(x.size for x in jax.tree.leaves(params))
+            routes = {"": params}
+            if isinstance(model, GatedDQN):
+                # force every sample cheap / heavy through the gate bias
+                gate = params["params"]["gate"]
+                routes = {
+                    f" ({name})": {
+                        "params": {
+                            **params["params"],
+                            "gate": {
+                                "kernel": jnp.zeros_like(gate["kernel"]),
+                                "bias": jnp.full_like(gate["bias"], bias),
+                            },
+                        }
+                    }
+                    for name, bias in (("all cheap", 10.0), ("all heavy", -10.0))
+                }
+            for suffix, route_params in routes.items():
+                apply = lambda image, arrow, p=route_params: model.apply(
+                    p, image, arrow
+                )
+                print(
+                    f"  {type(model).__name__ + suffix:22s} {num_params:9d} params "
+                    f"{flops_of(apply, image, arrow) / batch_size / 1e6:8.3f} MFLOPs/sample "
+                    f"{latency(apply, image, arrow) * 1e3:8.3f} ms/batch"
+                )
+
+    # wall time against the fraction of cheap-routed samples: the gate reads
+    # the first arrow component, which is +1 for cheap and -1 for heavy rows
+    image = rng.integers(0, 256, (batch_size, 88, 88), dtype=np.uint8)
+    heavy_buckets = (16, 32, 64, 128)
+    print(f"bucketed GatedDQN, batch {batch_size}, buckets {heavy_buckets}")
+    for model in (GatedDQN(4), GatedDQN(4, heavy_buckets=heavy_buckets)):
+        params = model.init(jax.random.PRNGKey(0), image, arrow)
+        gate = params["params"]["gate"]
+        params = {
+            "params": {
+                **params["params"],
+                "gate": {
+                    "kernel": jnp.zeros_like(gate["kernel"]).at[0, 0].set(10.0),
+                    "bias": jnp.zeros_like(gate["bias"]),
+                },
+            }
+        }
+        apply = jax.jit(model.apply)
+        for cheap_fraction in (0.0, 0.5, 0.75, 0.9, 0.95, 1.0):
+            arrow = rng.uniform(-1, 1, (batch_size, 4)).astype(np.float32)
+            arrow[:, 0] = np.where(
+                rng.permutation(batch_size) < cheap_fraction * batch_size, 1.0, -1.0
+            )
+            print(
+                f"  buckets {str(model.heavy_buckets):18s} cheap {cheap_fraction:4.0%} "
+                f"{latency(lambda i, a: apply(params, i, a), image, arrow) * 1e3:8.3f} ms/batch"
+            )
+
+    # DQN update throughput (forward, backward, Adam) of HeavyNet in float32
+    # and bfloat16
+    import optax
+
+    print(f"HeavyNet update, batch {batch_size}")
+    image = rng.integers(0, 256, (batch_size, 88, 88), dtype=np.uint8)
+    arrow = rng.uniform(-1, 1, (batch_size, 4)).astype(np.float32)
+    target = rng.normal(size=(batch_size, 4)).astype(np.float32)
+    tx = optax.adam(1e-4)
+    for dtype in (jnp.float32, jnp.bfloat16):
+        model = HeavyNet(4, dtype=dtype)
+        params = model.init(jax.random.PRNGKey(0), image, arrow)
+        opt_state = tx.init(params)
+
+        @jax.jit
+        def update(params, opt_state, image, arrow, target):
+            loss_fn = lambda p: ((model.apply(p, image, arrow) - target) ** 2).mean()
+            grads = jax.grad(loss_fn)(params)
+            updates, opt_state = tx.update(grads, opt_state)
+            return optax.apply_updates(params, updates), opt_state
+
+        seconds = latency(
+            lambda *inputs: update(params, opt_state, *inputs)[0],
+            image,
+            arrow,
+            target,
+        )
+        print(
+            f"  {jnp.dtype(dtype).name:9s} {seconds * 1e3:8.3f} ms, "
+            f"{batch_size / seconds:8.0f} samples/s"
+        )
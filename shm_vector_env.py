@@ -0,0 +1,213 @@
+"""
+Subprocess vector env that passes observations through shared memory.
+
+`gym.vector.AsyncVectorEnv` pickles every info dict and, unless
+`shared_memory` is on, every observation through a pipe per step. Here each
+worker writes its observation, reward and termination flags straight into
+preallocated `multiprocessing.shared_memory` arrays, which the trainer reads as
+numpy views. Only the command, the action and the (small) info dict cross the
+pipe. Autoreset follows `gym.vector.AutoresetMode.SAME_STEP`, so the returned
+`infos` carry `final_obs` / `final_info` exactly like `gym.vector.SyncVectorEnv`.
+"""
+
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+
+import gymnasium as gym
+import numpy as np
+from gymnasium.vector.utils import CloudpickleWrapper, batch_space
+
+
+def _allocate(specs: dict[str, tuple[tuple[int, ...], np.dtype]]):
+    """
+    Create one shared block per array spec; returns (blocks, numpy views)
+    """
+    blocks, views = {}, {}
+    for name, (shape, dtype) in specs.items():
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        blocks[name] = shared_memory.SharedMemory(create=True, size=nbytes)
+        views[name] = np.ndarray(shape, dtype=dtype, buffer=blocks[name].buf)
+    return blocks, views
+
+
+def _attach(names: dict[str, str], specs):
+    blocks, views = {}, {}
+    for key, (shape, dtype) in specs.items():
+        # workers share the parent's resource tracker, so attaching does not
+        # add a second owner; the parent unlinks the blocks on close
+        blocks[key] = shared_memory.SharedMemory(name=names[key])
+        views[key] = np.ndarray(shape, dtype=dtype, buffer=blocks[key].buf)
+    return blocks, views
+
+
+def _worker(index, env_fn, pipe, parent_pipe, names, specs, obs_keys):
+    parent_pipe.close()
+    blocks, views = _attach(names, specs)
+    env = env_fn()
+
+    def write_obs(prefix, obs):
+        for key in obs_keys:
+            views[f"{prefix}{key}"][index] = obs[key]
+
+    try:
+        while True:
+            command, data = pipe.recv()
+            if command == "reset":
+                obs, info = env.reset(**data)
+                write_obs("obs/", obs)
+                pipe.send(((info, False), True))
+            elif command == "step":
+                obs, reward, terminated, truncated, info = env.step(data)
+                views["reward"][index] = reward
+                views["terminated"][index] = terminated
+                views["truncated"][index] = truncated
+                episode_over = terminated or truncated
+                if episode_over:
+                    write_obs("final_obs/", obs)
+                    final_info = info
+                    obs, info = env.reset()
+                    info["final_info"] = final_info
+                write_obs("obs/", obs)
+                pipe.send(((info, episode_over), True))
+            elif command == "close":
+                pipe.send((None, True))
+                break
+            else:
+                raise RuntimeError(f"Received unknown command `{command}`")
+    except (KeyboardInterrupt, Exception):
+        pipe.send((traceback.format_exc(), False))
+    finally:
+        env.close()
+        for block in blocks.values():
+            block.close()
+
+
+class SharedMemoryVectorEnv(gym.vector.VectorEnv):
+    """
+    Steps `len(env_fns)` envs in subprocesses that exchange observations,
+    rewards and termination flags through shared memory.
+
+    Observations must be a `Dict` of `Box` spaces (e.g. TMaze after
+    `FilterObservation(["image", "arrow"])`). With `copy=False`, `reset` and
+    `step` return views into the shared arrays, which are overwritten by the
+    next `step`.
+    """
+
+    def __init__(self, env_fns, copy: bool = True, context: str | None = None):
+        self.num_envs = len(env_fns)
+        self.copy = copy
+
+        dummy_env = env_fns[0]()
+        self.metadata = {
+            **dummy_env.metadata,
+            "autoreset_mode": gym.vector.AutoresetMode.SAME_STEP,
+        }
+        self.render_mode = dummy_env.render_mode
+        self.single_observation_space = dummy_env.observation_space
+        self.single_action_space = dummy_env.action_space
+        dummy_env.close()
+        del dummy_env
+
+        assert isinstance(self.single_observation_space, gym.spaces.Dict) and all(
+            isinstance(space, gym.spaces.Box)
+            for space in self.single_observation_space.values()
+        ), "observations must be a Dict of Box spaces"
+        self.observation_space = batch_space(
+            self.single_observation_space, self.num_envs
+        )
+        self.action_space = batch_space(self.single_action_space, self.num_envs)
+
+        self._obs_keys = tuple(self.single_observation_space.keys())
+        specs = {"reward": ((self.num_envs,), np.float64)}
+        specs["terminated"] = specs["truncated"] = ((self.num_envs,), np.bool_)
+        for key, space in self.single_observation_space.items():
+            for prefix in ("obs/", "final_obs/"):
+                specs[f"{prefix}{key}"] = ((self.num_envs,) + space.shape, space.dtype)
+        self._blocks, self._views = _allocate(specs)
+        names = {key: block.name for key, block in self._blocks.items()}
+
+        ctx = mp.get_context(context)
+        self.parent_pipes, self.processes = [], []
+        for index, env_fn in enumerate(env_fns):
+            parent_pipe, child_pipe = ctx.Pipe()
+            process = ctx.Process(
+                target=_worker,
+                name=f"SharedMemoryWorker<{type(self).__name__}>-{index}",
+                args=(
+                    index,
+                    CloudpickleWrapper(env_fn),
+                    child_pipe,
+                    parent_pipe,
+                    names,
+                    specs,
+                    self._obs_keys,
+                ),
+                daemon=True,
+            )
+            self.parent_pipes.append(parent_pipe)
+            self.processes.append(process)
+            process.start()
+            child_pipe.close()
+
+    def reset(self, *, seed: int | list[int] | None = None, options=None):
+        if seed is None or isinstance(seed, int):
+            seed = [None if seed is None else seed + i for i in range(self.num_envs)]
+        assert len(seed) == self.num_envs
+
+        for pipe, env_seed in zip(self.parent_pipes, seed):
+            pipe.send(("reset", {"seed": env_seed, "options": options}))
+        infos = {}
+        for index, (info, _) in enumerate(self._receive()):
+            infos = self._add_info(infos, info, index)
+        return self._read("obs/"), infos
+
+    def step(self, actions):
+        for pipe, action in zip(self.parent_pipes, actions):
+            pipe.send(("step", action))
+
+        infos = {}
+        for index, (info, episode_over) in enumerate(self._receive()):
+            if episode_over:
+                info["final_obs"] = {
+                    key: self._views[f"final_obs/{key}"][index].copy()
+                    for key in self._obs_keys
+                }
+            infos = self._add_info(infos, info, index)
+
+        return (
+            self._read("obs/"),
+            self._views["reward"].copy(),
+            self._views["terminated"].copy(),
+            self._views["truncated"].copy(),
+            infos,
+        )
+
+    def _read(self, prefix: str):
+        obs = {key: self._views[f"{prefix}{key}"] for key in self._obs_keys}
+        return {key: x.copy() for key, x in obs.items()} if self.copy else obs
+
+    def _receive(self):
+        results = [pipe.recv() for pipe in self.parent_pipes]
+        for index, (result, success) in enumerate(results):
+            if not success:
+                raise RuntimeError(f"Worker {index} failed:\n{result}")
+        return [result for result, _ in results]
+
+    def close_extras(self, **kwargs):
+        for pipe, process in zip(self.parent_pipes, self.processes):
+            if process.is_alive():
+                pipe.send(("close", None))
+        for pipe, process in zip(self.parent_pipes, self.processes):
+            if process.is_alive():
+                try:
+                    pipe.recv()
+                except EOFError:
+                    pass
+            pipe.close()
+        for process in self.processes:
+            process.join()
+        self._views = {}
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
@@ -0,0 +1,62 @@
+"""
+`buffers.FrameTable` keeps serving the right frames for every live replay row
+while a long run interns far more unique frames than its initial capacity.
+"""
+
+import numpy as np
+import pytest
+
+from buffers import FrameTable
+
+
+def unique_frames(start, n):
+    "Frames that differ from every other frame in the run"
+    return np.arange(start, start + n, dtype=np.uint32).view(np.uint8).reshape(n, 2, 2)
+
+
+@pytest.mark.parametrize("hold_steps", [1, 3])
+def test_evicts_unreferenced_frames(hold_steps):
+    num_envs, replay_capacity = 2, 8
+    table = FrameTable(
+        64, (2, 2), replay_capacity, hold_steps=hold_steps, dtype=np.uint8
+    )
+    obs = unique_frames(0, num_envs)
+    # replay rows stored as (image frames, next image frames), oldest first
+    rows = []
+    image = table.intern(obs, 0)
+    # windows of pending transitions emulate `NStepBuffer` holding ids back
+    pending = []
+    for step in range(1000):
+        next_obs = unique_frames((step + 1) * num_envs, num_envs)
+        next_image = table.intern(next_obs, step)
+        pending.append((image, next_image, obs, next_obs))
+        if len(pending) == hold_steps:
+            # fold the window into one transition, as `NStepBuffer` does
+            first, last = pending[0], pending[-1]
+            pending.pop(0)
+            table.store(first[0], last[1])
+            rows.extend(zip(first[2], last[3]))
+            rows = rows[-replay_capacity:]
+            stored = table.rows[
+                (table.pos - len(rows) + np.arange(len(rows))) % replay_capacity
+            ]
+            frames = np.asarray(table.frames)
+            for (image_id, next_id), (frame, next_frame) in zip(stored, rows):
+                np.testing.assert_array_equal(frames[image_id], frame)
+                np.testing.assert_array_equal(frames[next_id], next_frame)
+        obs, image = next_obs, next_image
+
+    assert table.capacity == 64
+    assert len(table) <= table.capacity
+
+
+def test_grows_when_everything_is_referenced():
+    table = FrameTable(4, (2, 2), 16, dtype=np.uint8)
+    for step in range(8):
+        ids = table.intern(unique_frames(2 * step, 2), step)
+        table.store(ids[:1], ids[1:])
+    assert table.capacity == 16
+    assert len(table) == 16
+    np.testing.assert_array_equal(
+        np.asarray(table.frames)[table.rows[:8].ravel()], unique_frames(0, 16)
+    )
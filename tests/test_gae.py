@@ -0,0 +1,57 @@
+"""
+The blocked `main.compute_gae` kernel against the step-by-step GAE loop it
+replaced in the PPO update.
+"""
+
+import pytest
+import torch
+
+from main import compute_gae
+
+
+def reference_gae(rewards, values, dones, next_value, next_done, gamma, gae_lambda):
+    "The original reverse loop over time steps"
+    num_steps = rewards.shape[0]
+    advantages = torch.zeros_like(rewards)
+    lastgaelam = 0
+    for t in reversed(range(num_steps)):
+        if t == num_steps - 1:
+            nextnonterminal = 1.0 - next_done
+            nextvalues = next_value
+        else:
+            nextnonterminal = 1.0 - dones[t + 1]
+            nextvalues = values[t + 1]
+        delta = rewards[t] + gamma * nextvalues * nextnonterminal - values[t]
+        advantages[t] = lastgaelam = (
+            delta + gamma * gae_lambda * nextnonterminal * lastgaelam
+        )
+    return advantages
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (17, 4), (2048, 4)])
+@pytest.mark.parametrize("done_density", [0.0, 0.05, 0.5, 1.0])
+@pytest.mark.parametrize("gamma,gae_lambda", [(0.99, 0.95), (1.0, 1.0), (0.5, 0.0)])
+def test_compute_gae_matches_loop(shape, done_density, gamma, gae_lambda):
+    generator = torch.Generator().manual_seed(0)
+    num_steps, num_envs = shape
+
+    def sample(*size):
+        return torch.randn(size, generator=generator, dtype=torch.float64)
+
+    def sample_dones(*size):
+        return (
+            torch.rand(size, generator=generator, dtype=torch.float64) < done_density
+        ).to(torch.float64)
+
+    rewards, values = sample(num_steps, num_envs), sample(num_steps, num_envs)
+    dones = sample_dones(num_steps, num_envs)
+    next_value, next_done = sample(1, num_envs), sample_dones(num_envs)
+
+    expected = reference_gae(
+        rewards, values, dones, next_value.reshape(-1), next_done, gamma, gae_lambda
+    )
+    advantages = compute_gae(
+        rewards, values, dones, next_value, next_done, gamma, gae_lambda
+    )
+    assert advantages.shape == shape
+    torch.testing.assert_close(advantages, expected, rtol=1e-8, atol=1e-8)
@@ -0,0 +1,80 @@
+"""
+Parity of the functional `tmaze_jax.TMazeJax` (used by `main_dqn.py
+--on-device`) with the gymnasium `main_dqn.TMaze` it reimplements.
+"""
+
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from main_dqn import GrayscaleImgObsWrapper, SymbolicObsWrapper, TMaze
+from tmaze_jax import TMazeJax, TMazeState
+
+
+def state_of(env: TMaze) -> TMazeState:
+    "The `TMazeState` matching the current state of a numpy `TMaze`"
+    return TMazeState(
+        key=jnp.zeros(2, dtype=jnp.uint32),
+        agent_pos=jnp.array(env.agent_pos, dtype=jnp.int32),
+        goal_is_right=jnp.array(env.goal_position == (env.width - 2, 1)),
+        hint_mask=jnp.array(env.hint_mask),
+        step_count=jnp.array(env.step_count, dtype=jnp.int32),
+        num_episodes=jnp.array(env.num_episodes, dtype=jnp.int32),
+    )
+
+
+def rollout(env, num_steps: int, seed: int):
+    """
+    Yield (obs, action, reward, terminated, truncated, state before the
+    step) along a random-action trajectory, resetting after each episode
+    """
+    rng = np.random.default_rng(seed)
+    obs, _ = env.reset(seed=seed)
+    for _ in range(num_steps):
+        state = state_of(env.unwrapped)
+        action = int(rng.integers(4))
+        obs, reward, terminated, truncated, _ = env.step(action)
+        yield obs, action, reward, terminated, truncated, state
+        if terminated or truncated:
+            obs, _ = env.reset()
+
+
+@pytest.mark.parametrize("invisible_goal", [False, True])
+@pytest.mark.parametrize(
+    "tile_size,symbolic", [(1, False), (2, False), (8, False), (8, True)]
+)
+@pytest.mark.parametrize("path_hints", [False, True])
+def test_render_matches_numpy_env(invisible_goal, tile_size, symbolic, path_hints):
+    env = TMaze(size=11, invisible_goal=invisible_goal)
+    if path_hints:
+        env.path_episode_threshold = 0
+    if symbolic:
+        env = SymbolicObsWrapper(env)
+    else:
+        env = GrayscaleImgObsWrapper(env, tile_size=tile_size)
+    jax_env = TMazeJax(
+        size=11, invisible_goal=invisible_goal, tile_size=tile_size, symbolic=symbolic
+    )
+
+    for obs, *_ in rollout(env, 240, seed=tile_size):
+        frame = np.asarray(jax_env.render(state_of(env.unwrapped)))
+        assert frame.shape == jax_env.image_shape
+        np.testing.assert_array_equal(frame, obs["image"])
+
+
+def test_step_matches_numpy_env():
+    env = TMaze(size=11)
+    jax_env = TMazeJax(size=11)
+    num_terminated = num_truncated = 0
+    for obs, action, reward, terminated, truncated, state in rollout(env, 1000, 0):
+        next_state, _, jax_reward, jax_terminated, jax_truncated = jax_env.step(
+            state, action
+        )
+        np.testing.assert_array_equal(next_state.agent_pos, env.agent_pos)
+        assert float(jax_reward) == pytest.approx(reward, rel=1e-6)
+        assert bool(jax_terminated) == terminated
+        assert bool(jax_truncated) == truncated
+        num_terminated += terminated
+        num_truncated += truncated
+    # the trajectory covers both ways an episode ends
+    assert num_terminated and num_truncated
@@ -0,0 +1,290 @@
+"""
+Stateless JAX reimplementation of the `TMaze` environment from `main_dqn.py`.
+
+`reset(key)` and `step(state, action)` are pure functions, so they can be
+`jax.jit`-ed and `jax.vmap`-ed over thousands of environments. Frames are
+assembled from a grayscale tile atlas that is rendered once on the host with
+the same MiniGrid primitives as `DirectionlessGrid.render_tile`, so the images
+match `RGBImgObsWrapper` + `GrayscaleObservation` pixel for pixel. With
+`symbolic=True` the frame is instead a one-hot grid of tile kinds.
+"""
+
+import flax
+import jax
+import jax.numpy as jnp
+import numpy as np
+from minigrid.core.world_object import Goal, Lava, Wall
+from minigrid.utils.rendering import (
+    downsample,
+    fill_coords,
+    point_in_circle,
+    point_in_rect,
+)
+
+# Tile kinds of the static layout; an agent standing on a tile of kind `k`
+# uses atlas entry `k + NUM_TILE_KINDS`.
+EMPTY = 0
+WALL = 1
+GOAL = 2
+LAVA = 3
+HINT = 4
+NUM_TILE_KINDS = 5
+
+# Tile kind of each MiniGrid object as (type, color)
+OBJECT_KINDS = {
+    ("wall", "grey"): WALL,
+    ("goal", "green"): GOAL,
+    ("lava", "red"): LAVA,
+    ("goal", "grey"): HINT,
+}
+
+# Same ordering as `main_dqn.Actions`: left, forward, right, backward
+ACTION_DELTAS = np.array([(-1, 0), (0, -1), (1, 0), (0, 1)], dtype=np.int32)
+
+
+def to_grayscale(img: np.ndarray) -> np.ndarray:
+    """
+    Same conversion as `main_dqn.GrayscaleObservation`
+    """
+    return np.sum(
+        255 - np.multiply(img, np.array([0.2125, 0.7154, 0.0721])), axis=-1
+    ).astype(np.uint8)
+
+
+def render_tile(obj, agent: bool, tile_size: int, subdivs: int = 3) -> np.ndarray:
+    """
+    Render a single RGB tile exactly like `DirectionlessGrid.render_tile`
+    """
+    img = np.zeros(shape=(tile_size * subdivs, tile_size * subdivs, 3), dtype=np.uint8)
+
+    # Draw the grid lines (top and left edges)
+    fill_coords(img, point_in_rect(0, 0.031, 0, 1), (100, 100, 100))
+    fill_coords(img, point_in_rect(0, 1, 0, 0.031), (100, 100, 100))
+
+    if obj is not None:
+        obj.render(img)
+
+    if agent:
+        fill_coords(img, point_in_circle(0.5, 0.5, 0.3), (255, 0, 0))
+
+    # `downsample` averages to float; the grid renderer truncates it back to
+    # uint8 when copying the tile into the frame
+    return downsample(img, subdivs).astype(np.uint8)
+
+
+def build_tile_atlas(tile_size: int) -> np.ndarray:
+    """
+    Grayscale tiles indexed by `kind + NUM_TILE_KINDS * agent_here`
+    Shape: (2 * NUM_TILE_KINDS, tile_size, tile_size) uint8
+    """
+    objects = {
+        EMPTY: None,
+        WALL: Wall(),
+        GOAL: Goal(),
+        LAVA: Lava(),
+        HINT: Goal("grey"),
+    }
+    tiles = [
+        to_grayscale(render_tile(objects[kind], agent, tile_size))
+        for agent in (False, True)
+        for kind in range(NUM_TILE_KINDS)
+    ]
+    return np.stack(tiles)
+
+
+def build_layout(size: int) -> np.ndarray:
+    """
+    Static wall layout of `TMaze._gen_grid`, indexed as [y, x]
+    """
+    assert size % 2 == 1  # odd size
+    walls = np.zeros((size, size), dtype=bool)
+    walls[0, :] = walls[-1, :] = walls[:, 0] = walls[:, -1] = True
+    walls[2 : size - 1, size // 2 - 1] = True
+    walls[2 : size - 1, size // 2 + 1] = True
+    walls[2, : size // 2] = True
+    walls[2, size // 2 + 1 :] = True
+    return walls
+
+
+@flax.struct.dataclass
+class TMazeState:
+    key: jax.Array
+    agent_pos: jax.Array  # (2,) int32 as (x, y)
+    goal_is_right: jax.Array  # () bool
+    hint_mask: jax.Array  # (4,) bool, grey boxes at left/right/up/down
+    step_count: jax.Array  # () int32
+    num_episodes: jax.Array  # () int32
+
+
+class TMazeJax:
+    """
+    Functional TMaze with the same layout, four-way `Actions`, goal/lava
+    corner choice, grey-box hint cells, arrow vector and reward
+    `1 - 0.9 * step_count / max_steps` as `main_dqn.TMaze`.
+
+    Observations are dicts with an `image` of shape
+    `(size * tile_size, size * tile_size)` uint8 and an `arrow` of shape (4,).
+    With `symbolic` the image is a `(size, size, NUM_TILE_KINDS + 1)` one-hot
+    grid of tile kinds plus an agent plane, like `DirectionlessGrid.render_symbolic`.
+    """
+
+    num_actions = len(ACTION_DELTAS)
+
+    def __init__(
+        self,
+        size: int = 11,
+        max_steps: int | None = None,
+        invisible_goal: bool = False,
+        path_episode_threshold: int = 2000,
+        tile_size: int = 8,
+        symbolic: bool = False,
+    ):
+        self.size = size
+        self.max_steps = 2 * size**2 if max_steps is None else max_steps
+        self.invisible_goal = invisible_goal
+        self.path_episode_threshold = path_episode_threshold
+        self.tile_size = tile_size
+        self.symbolic = symbolic
+
+        self.walls = build_layout(size)
+        self.atlas = build_tile_atlas(tile_size)
+        self.start_pos = np.array((size // 2, size - 2), dtype=np.int32)
+        self.goal_positions = np.array(((1, 1), (size - 2, 1)), dtype=np.int32)
+        # left, right, up and down hint boxes, see `TMaze.gen_obs`
+        self.hint_positions = np.array(
+            (
+                (size * 3 // 4 - 1, size * 2 // 3 - 1),
+                (size * 3 // 4 + 1, size * 2 // 3 - 1),
+                (size * 3 // 4, size * 2 // 3 - 2),
+                (size * 3 // 4, size * 2 // 3),
+            ),
+            dtype=np.int32,
+        )
+
+    @property
+    def image_shape(self) -> tuple[int, ...]:
+        if self.symbolic:
+            return (self.size, self.size, NUM_TILE_KINDS + 1)
+        return (self.size * self.tile_size, self.size * self.tile_size)
+
+    def reset(self, key: jax.Array, num_episodes=0):
+        """
+        Start a new episode; `num_episodes` is the number of episodes played
+        so far and drives the `path_episode_threshold` hint regime.
+        """
+        key, goal_key = jax.random.split(key)
+        state = TMazeState(
+            key=key,
+            agent_pos=jnp.asarray(self.start_pos),
+            goal_is_right=jax.random.bernoulli(goal_key),
+            hint_mask=jnp.zeros(4, dtype=bool),
+            step_count=jnp.zeros((), dtype=jnp.int32),
+            num_episodes=jnp.asarray(num_episodes, dtype=jnp.int32) + 1,
+        )
+        return self._observe(state)
+
+    def step(self, state: TMazeState, action):
+        """
+        Returns (state, obs, reward, terminated, truncated)
+        """
+        goal_pos, lava_pos = self._goal_and_lava(state)
+        fwd_pos = state.agent_pos + jnp.asarray(ACTION_DELTAS)[action]
+        blocked = jnp.asarray(self.walls)[fwd_pos[1], fwd_pos[0]]
+        agent_pos = jnp.where(blocked, state.agent_pos, fwd_pos)
+
+        step_count = state.step_count + 1
+        reached_goal = jnp.all(fwd_pos == goal_pos)
+        terminated = reached_goal | jnp.all(fwd_pos == lava_pos)
+        truncated = step_count >= self.max_steps
+        reward = jnp.where(
+            reached_goal, 1 - 0.9 * (step_count / self.max_steps), 0.0
+        ).astype(jnp.float32)
+
+        state = state.replace(agent_pos=agent_pos, step_count=step_count)
+        state, obs = self._observe(state)
+        return state, obs, reward, terminated, truncated
+
+    def autoreset_step(self, state: TMazeState, action):
+        """
+        `step` followed by a reset wherever the episode ended, like a vector
+        env in same-step autoreset mode.
+        Returns (state, obs, reward, terminated, truncated, final_obs) where
+        `final_obs` is the observation `step` produced before the reset.
+        """
+        state, final_obs, reward, terminated, truncated = self.step(state, action)
+        key, reset_key = jax.random.split(state.key)
+        reset_state, reset_obs = self.reset(reset_key, state.num_episodes)
+
+        done = terminated | truncated
+        state = jax.tree.map(
+            lambda r, s: jnp.where(done, r, s), reset_state, state.replace(key=key)
+        )
+        obs = jax.tree.map(lambda r, o: jnp.where(done, r, o), reset_obs, final_obs)
+        return state, obs, reward, terminated, truncated, final_obs
+
+    def render(self, state: TMazeState) -> jax.Array:
+        """
+        Assemble the full grayscale frame with a single gather from the atlas,
+        or the one-hot kind planes if `symbolic`
+        """
+        size = self.size
+        goal_pos, lava_pos = self._goal_and_lava(state)
+        kinds = jnp.where(jnp.asarray(self.walls), WALL, EMPTY)
+        if not self.invisible_goal:
+            kinds = kinds.at[goal_pos[1], goal_pos[0]].set(GOAL)
+            kinds = kinds.at[lava_pos[1], lava_pos[0]].set(LAVA)
+        hints = jnp.asarray(self.hint_positions)
+        kinds = kinds.at[hints[:, 1], hints[:, 0]].set(
+            jnp.where(state.hint_mask, HINT, kinds[hints[:, 1], hints[:, 0]])
+        )
+        if self.symbolic:
+            planes = jnp.concatenate(
+                [
+                    jax.nn.one_hot(kinds, NUM_TILE_KINDS, dtype=bool),
+                    jnp.zeros((size, size, 1), dtype=bool)
+                    .at[state.agent_pos[1], state.agent_pos[0]]
+                    .set(True),
+                ],
+                axis=-1,
+            )
+            return planes.astype(jnp.uint8) * 255
+
+        kinds = kinds.at[state.agent_pos[1], state.agent_pos[0]].add(NUM_TILE_KINDS)
+
+        tiles = jnp.asarray(self.atlas)[kinds]  # (H, W, tile, tile)
+        return tiles.transpose(0, 2, 1, 3).reshape(
+            size * self.tile_size, size * self.tile_size
+        )
+
+    def _goal_and_lava(self, state: TMazeState):
+        goal_positions = jnp.asarray(self.goal_positions)
+        goal_idx = state.goal_is_right.astype(jnp.int32)
+        return goal_positions[goal_idx], goal_positions[1 - goal_idx]
+
+    def _observe(self, state: TMazeState):
+        key, hint_key, arrow_key = jax.random.split(state.key, 3)
+        on_top_row = state.agent_pos[1] == 1
+
+        # Past the threshold a single box points at the goal side once the
+        # agent reaches the top row; before it the boxes are random noise
+        path_hint = jnp.where(
+            on_top_row,
+            jnp.where(state.goal_is_right, 1, 0),
+            2,
+        )
+        hint_mask = jnp.where(
+            state.num_episodes > self.path_episode_threshold,
+            jnp.arange(4) == path_hint,
+            jax.random.uniform(hint_key, (4,)) < 0.5,
+        )
+
+        at_junction = on_top_row & (state.agent_pos[0] == (self.size - 1) // 2)
+        arrow = jnp.where(
+            at_junction,
+            jax.nn.one_hot(state.goal_is_right.astype(jnp.int32), self.num_actions),
+            jax.random.uniform(arrow_key, (self.num_actions,), minval=-1.0, maxval=1.0),
+        )
+
+        state = state.replace(key=key, hint_mask=hint_mask)
+        obs = {"image": self.render(state), "arrow": arrow.astype(jnp.float32)}
+        return state, obs